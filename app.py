@@ -1,17 +1,62 @@
 import json
 import os
 import io
+import pathlib
 import base64
 import hmac
 import re
 import tempfile
 import subprocess
-from flask import Flask, g, request, send_file
+import hashlib
+import importlib.metadata
+import importlib.util
+import resource
+import select
+import shutil
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeout
+from flask import (
+    Flask, Request, Response, g, has_request_context, make_response,
+    render_template, request, send_file, stream_with_context,
+)
 from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import secure_filename
 from docxtpl import DocxTemplate, InlineImage
-from jinja2 import Environment
+from jinja2 import Environment, TemplateError, meta
+from docx.opc.packuri import CONTENT_TYPES_URI, PACKAGE_URI
+from docx.opc.pkgwriter import _ContentTypesItem
+from docx.parts.image import ImagePart
+from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_BREAK
 from docx.shared import Inches
-from PIL import Image, ImageOps
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+# HEIC, which is what an iPhone takes, needs pillow-heif; Pillow reads WebP and
+# AVIF itself. Without it a HEIC upload fails the way any unreadable photograph
+# does, and the app goes on converting to JPEG on the phone as it always has.
+try:
+    from pillow_heif import register_heif_opener
+except ImportError:
+    register_heif_opener = None
+else:
+    register_heif_opener()
+
+from bodies import BadBody, DecompressingMiddleware
+from cache import from_url as open_cache
+from metrics import Metrics
+from probe import TooManyPixels, probe
+from registry import TemplateRegistry
+import sections
+from scheduling import Abandoned, FairScheduler, Lane, QueueFull, QueueTimeout, parse_weights
+from survey import OPTIONS, SEVERITIES, parse as parse_survey
 
 app = Flask(__name__)
 
@@ -48,6 +93,17 @@ def _temp_file(suffix):
     return path
 
 
+def _temp_dir():
+    """A temporary directory this request will clean up, contents and all."""
+    path = tempfile.mkdtemp()
+    dirs = getattr(g, '_temp_dirs', None)
+    if dirs is None:
+        dirs = []
+        g._temp_dirs = dirs
+    dirs.append(path)
+    return path
+
+
 @app.teardown_request
 def _remove_temp_files(_error):
     for path in getattr(g, '_temp_paths', []):
@@ -55,6 +111,639 @@ def _remove_temp_files(_error):
             os.remove(path)
         except OSError as e:
             print(f"[⚠️] Could not remove {path}: {e}", flush=True)
+    for path in getattr(g, '_temp_dirs', []):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+# The lean rendering mode. A report used to hold every photograph three times
+# over by the time it was saved: the decoded bitmap Pillow was still holding,
+# the JPEG bytes python-docx read in to make an image part, and the same bytes
+# again while the zip was written. That is why render.yaml runs one worker. With
+# this on, each photograph is decoded at the size it is going to be used, its
+# buffers are let go before the next one is opened, and once it is in the
+# document its bytes go back to the prepared file on disk until the save reads
+# them out one at a time.
+LEAN_RENDER = os.environ.get('REPORT_LEAN_RENDER') == '1'
+
+# How far one report may grow the worker's memory, in megabytes. Unset means no
+# limit. Threads share a process, so this is measured as growth since the
+# request started -- two reports at once each see some of the other's, which
+# errs on the side of refusing rather than of running out.
+RSS_CEILING_MB = int(os.environ.get('REPORT_RSS_CEILING_MB') or 0)
+
+
+class _MemoryCeiling(Exception):
+    """A report grew past REPORT_RSS_CEILING_MB and was stopped."""
+
+
+@app.errorhandler(_MemoryCeiling)
+def _report_over_memory(error):
+    print(f"[🧠] Stopped a report at the memory ceiling: {error}", flush=True)
+    return {"error": "The server is too busy to build that report. Try again shortly."}, 503
+
+
+def _rss_bytes():
+    """Resident memory of this process now, or None where it cannot be read.
+
+    getrusage only knows the peak since the process started, which says nothing
+    about one request, so this reads /proc. Off Linux there is no /proc and the
+    ceiling simply does not apply.
+    """
+    try:
+        with open('/proc/self/statm') as handle:
+            return int(handle.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _note_peak():
+    """Note this report's high-water mark so far, and return how far it has
+    grown, in bytes -- or None where that cannot be told."""
+    if not has_request_context():
+        return None
+    rss = _rss_bytes()
+    start = getattr(g, '_rss_start', None)
+    if rss is None or start is None:
+        return None
+    g._rss_peak = max(getattr(g, '_rss_peak', start), rss)
+    return rss - start
+
+
+def _check_memory(stage):
+    """Note the high-water mark so far, and stop if it is past the ceiling."""
+    grown = _note_peak()
+    if grown is None:
+        return
+    grown_mb = grown / (1024 * 1024)
+    if RSS_CEILING_MB and grown_mb > RSS_CEILING_MB:
+        raise _MemoryCeiling(
+            f"grew {grown_mb:.0f}MB by {stage}, ceiling {RSS_CEILING_MB}MB"
+        )
+
+
+class _ClientGone(Exception):
+    """The client hung up, so nobody is waiting for this report any more."""
+
+
+@app.errorhandler(_ClientGone)
+def _report_abandoned(error):
+    print(f"[📵] Client went away {error}; stopped building its report", flush=True)
+    # Nobody will read this. 499 is what nginx logs for the same thing, and
+    # it keeps an abandoned report out of the 5xx counts.
+    return {"error": "Client closed the connection."}, 499
+
+
+def _client_connected():
+    """False once the client has closed its end of the connection.
+
+    A phone that loses signal, or an app that gives up waiting, closes the
+    socket; Render's proxy closes ours when that happens. A closed socket reads
+    as ready with nothing in it, so this peeks without taking anything. Ready
+    with bytes in it is the rest of a body or the next request -- still there.
+    Under a server that does not say which socket is ours, assume connected.
+    """
+    sock = request.environ.get('gunicorn.socket') or request.environ.get('werkzeug.socket')
+    if sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return True
+        return sock.recv(1, socket.MSG_PEEK) != b''
+    except ValueError:
+        # A TLS socket will not peek. There is no way to tell from here.
+        return True
+    except OSError:
+        return False
+
+
+def _checkpoint(stage):
+    """Between stages and between photographs: stop if nobody is waiting any
+    more, or if this report has grown past the memory ceiling."""
+    if not _client_connected():
+        raise _ClientGone(f"at {stage}")
+    _check_memory(stage)
+
+
+def _run_converter(args, timeout, still_wanted):
+    """Run a conversion, asking `still_wanted` every half second while it does.
+
+    subprocess.run would wait out the whole conversion -- up to two minutes of
+    a request thread and a CPU -- for a client that was gone after ten seconds.
+    The converter gets its own process group, because the libreoffice command
+    starts soffice.bin under it and killing only the parent would leave that
+    running.
+
+    False from `still_wanted` means the client went. When the conversion is
+    unwanted for some other reason it raises that instead, and the converter
+    is stopped the same way before it goes up.
+    """
+    proc = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        start_new_session=True,
+    )
+    waited = 0.0
+    while True:
+        try:
+            stdout, stderr = proc.communicate(timeout=0.5)
+            return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+        except subprocess.TimeoutExpired:
+            waited += 0.5
+            try:
+                if not still_wanted():
+                    raise _ClientGone("during PDF conversion")
+                if waited >= timeout:
+                    raise subprocess.TimeoutExpired(args, timeout)
+            except BaseException:
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                proc.communicate()
+                raise
+
+
+# How long a report may take, in seconds, when the client does not say. Under
+# gunicorn's 180, because gunicorn does not fail a request that runs over -- it
+# kills the worker, and every other report on it goes too. A client that sends
+# X-Report-Deadline gets that many seconds instead, never more than this.
+DEFAULT_DEADLINE = float(os.environ.get('REPORT_DEADLINE_SECONDS') or 170)
+
+# What the stages after the photographs are budgeted, in seconds. Rendering a
+# sixty-photograph survey and saving it takes about ten here; a PDF of one is
+# rarely under thirty. These are what is held back for them, not limits.
+RENDER_BUDGET = 15
+PDF_BUDGET = 30
+
+# What a photograph whose header could not be read is assumed to take to
+# prepare. The rest are estimated from their headers, by probe.py.
+PHOTO_SECONDS = 0.25
+
+# The width photographs drop to once there is not time to prepare them at the
+# full 1200. Still wider than 4.5" at 150dpi, so the page does not show it much.
+REDUCED_PHOTO_WIDTH = 800
+
+
+def _start_deadline():
+    """Start this report's clock. The time it waits for a slot counts: the app
+    is waiting all the same."""
+    try:
+        seconds = float(request.headers.get('X-Report-Deadline', DEFAULT_DEADLINE))
+    except ValueError:
+        seconds = DEFAULT_DEADLINE
+    seconds = min(max(seconds, 0.0), DEFAULT_DEADLINE)
+    g._deadline = time.monotonic() + seconds
+    g._degraded = []
+
+
+def _plan_photos(seconds, pdf):
+    """Say what this report's photographs are estimated to take to prepare, in
+    all, and whether it is to be a PDF, so they can be given their share of
+    the time."""
+    g._photo_seconds_left = seconds
+    g._held_back = RENDER_BUDGET + (PDF_BUDGET if pdf else 0)
+    # How long they are really taking, over what they were estimated to.
+    g._photo_pace = 1.0
+
+
+def _remaining():
+    return g._deadline - time.monotonic()
+
+
+def _degrade(what):
+    """Note that this report was made worse on purpose, to be in time."""
+    if what not in g._degraded:
+        g._degraded.append(what)
+        print(f"[⏱️] {what}: {_remaining():.0f}s left", flush=True)
+
+
+@app.after_request
+def _report_headers(response):
+    degraded = getattr(g, '_degraded', None)
+    if degraded:
+        response.headers['X-Report-Degraded'] = ",".join(degraded)
+    waited = getattr(g, '_queue_wait', None)
+    if waited is not None:
+        response.headers['X-Report-Queue-Wait'] = f"{waited:.3f}"
+    if getattr(g, '_size_budget', None) is not None and hasattr(g, '_report_bytes'):
+        response.headers['X-Report-Bytes'] = str(g._report_bytes)
+    if getattr(g, '_cached', False):
+        response.headers['X-Report-Cache'] = 'hit'
+    return response
+
+
+def _prepare_photo(path, found=None):
+    """prepare_image at whatever width there is time for. `found` is the
+    photograph's Probe, if its header could be read.
+
+    The photographs share what is left once rendering, saving and any PDF have
+    been held back. When the ones still to come would not fit -- their
+    estimates, scaled by how this report's photographs have gone against
+    theirs so far -- the rest are prepared narrower. Once narrow, they stay
+    narrow -- a report with some photographs sharp and some soft looks like a
+    fault.
+
+    One the header says is upright, small enough and in a format Word shows is
+    used as it is, without being opened again or hashed for the cache:
+    prepare_image would only have handed it back.
+    """
+    estimate = _photo_seconds(found)
+    needed = g._photo_seconds_left * g._photo_pace
+    if 'photos-reduced' in g._degraded or needed > _remaining() - g._held_back:
+        _degrade('photos-reduced')
+        width = REDUCED_PHOTO_WIDTH
+    else:
+        width = 1200
+
+    if found is not None and found.needs_nothing(width, WORD_FORMATS):
+        metrics.count('photos_untouched')
+        g._photo_seconds_left = max(g._photo_seconds_left - estimate, 0)
+        return path
+
+    started = time.monotonic()
+    cache = getattr(g, '_photo_cache', None)
+    if cache is not None:
+        ready = cache.prepared(path, width)
+    else:
+        ready = _prepare_shared(path, width)
+    took = time.monotonic() - started
+    # A running average of actual over estimate, leaning on the latest. It
+    # picks up what the estimates cannot know: a busy CPU, a cache hit.
+    if estimate:
+        g._photo_pace = (g._photo_pace + took / estimate) / 2
+    g._photo_seconds_left = max(g._photo_seconds_left - estimate, 0)
+    return ready
+
+
+# How much memory preparing one photograph may be estimated to need, in
+# megabytes, before the report is refused. A 48 megapixel HEIC needs about 150;
+# a JPEG of any size needs much less under lean rendering, which decodes it
+# scaled. What this stops is the photograph whose header says it is tens of
+# thousands of pixels on a side -- a few kilobytes on the wire, gigabytes once
+# decoded, and the end of the worker.
+MAX_PHOTO_MB = int(os.environ.get('REPORT_MAX_PHOTO_MB') or 200)
+
+# Of a base64 photograph, how much is decoded to read its header. The header
+# and the EXIF are in the first few tens of kilobytes of anything a phone sends.
+BASE64_HEAD = 256 * 1024
+
+# What a report needs besides its photographs, in megabytes: the template, the
+# rendered XML and the writer's buffers. Measured with bench.py on the owner
+# template with a full findings list.
+RENDER_BASE_MB = 12
+
+# Bytes a prepared photograph comes to in the report, per pixel placed: a
+# JPEG at quality 85. bench.py's 1200 pixel wide photographs come to about a
+# quarter of a megabyte each.
+PREPARED_BYTES_PER_PIXEL = 0.25
+
+# One contact sheet, in appendix mode: a letter page at APPENDIX_DPI.
+SHEET_BYTES = 1700 * 2200 * 3
+
+
+@app.errorhandler(TooManyPixels)
+def _too_many_pixels(error):
+    print(f"[🧨] Refused a report: {error}", flush=True)
+    metrics.count('photos_refused_pixels')
+    return {
+        "error": f"The photograph in {error.field} is too large to open"
+                 + (f" ({error.width}x{error.height} pixels)" if error.width else "")
+                 + ". Send it at a smaller size."
+    }, 413
+
+
+def _photo_seconds(found):
+    if found is None:
+        return PHOTO_SECONDS
+    return found.seconds(1200, LEAN_RENDER, WORD_FORMATS)
+
+
+def _probe_photos(survey):
+    """Every photograph's Probe, by field -- None for one whose header could
+    not be read -- from headers alone, before anything is decoded or queued.
+
+    Raises TooManyPixels for the first that would need more than MAX_PHOTO_MB
+    to prepare.
+    """
+    found = {}
+    for photo in survey.photos + list(survey.finding_photos.values()):
+        if photo.file is not None:
+            found[photo.field] = probe(photo.file.stream, photo.field)
+            continue
+        head = photo.base64[:BASE64_HEAD]
+        try:
+            head = base64.b64decode(head[:len(head) - len(head) % 4])
+        except ValueError:
+            found[photo.field] = None
+            continue
+        found[photo.field] = probe(io.BytesIO(head), photo.field)
+
+    limit = MAX_PHOTO_MB * 1024 * 1024
+    for field, photo in found.items():
+        if photo is not None and photo.decode_bytes(1200, LEAN_RENDER) > limit:
+            raise TooManyPixels(field, photo.width, photo.height, photo.decode_bytes(1200, LEAN_RENDER))
+    return found
+
+
+def _memory_estimate(survey, found, names=None):
+    """Roughly how far building this report will grow the worker, in bytes.
+
+    Photographs are prepared one at a time, so only the largest decode counts
+    in full. What each placed photograph comes to is in the finished report,
+    which is held whole to be sent. `names` is what the template refers to,
+    so that photographs it has no place for are not counted.
+
+    Calibrated against bench.py's surveys, lean and not: this is at or a
+    little over the highest peak growth it measures for each in a fresh
+    worker. A worker that has built reports before grows less than this, into
+    memory it already has.
+    """
+    estimate = RENDER_BASE_MB * 1024 * 1024
+    estimate += max(
+        (photo.decode_bytes(1200, LEAN_RENDER) for photo in found.values() if photo is not None),
+        default=0,
+    )
+    placed = set(survey.photo_fields(names))
+    for photo in survey.photos + list(survey.finding_photos.values()):
+        if photo.field not in placed:
+            continue
+        if photo.file is not None:
+            size = _upload_size(photo.file)
+        else:
+            size = len(photo.base64) * 3 // 4
+        prepared = _prepared_bytes(found.get(photo.field), size)
+        # Without lean rendering the prepared bytes are in the document too,
+        # though the save has let go of some by the time the report is read:
+        # bench.py measures half as much again, not twice.
+        estimate += prepared if LEAN_RENDER else prepared * 3 // 2
+    if survey.options.get('photo_appendix') == '1':
+        estimate += SHEET_BYTES
+    return estimate
+
+
+def _prepared_bytes(found, size):
+    """What a photograph of `size` bytes comes to once prepared."""
+    if found is None or found.needs_nothing(1200, WORD_FORMATS):
+        return size
+    width, height = found.width, found.height
+    if found.orientation in (5, 6, 7, 8):
+        width, height = height, width
+    if width > 1200:
+        width, height = 1200, height * 1200 // width
+    return int(width * height * PREPARED_BYTES_PER_PIXEL)
+
+
+def _upload_size(file):
+    """Bytes in an uploaded file, without reading it."""
+    stream = file.stream
+    here = stream.tell()
+    try:
+        return stream.seek(0, os.SEEK_END)
+    finally:
+        stream.seek(here)
+
+
+class _DiskImagePart(ImagePart):
+    """An image part whose bytes stay in the prepared file until the save.
+
+    python-docx keeps every image part's bytes in memory from the moment it is
+    inserted. This reads them back only when something asks -- which, after
+    rendering, is the package writer, one part at a time.
+    """
+
+    @property
+    def blob(self):
+        with open(self._path, 'rb') as handle:
+            return handle.read()
+
+    @property
+    def sha1(self):
+        # Asked of every existing part each time a picture is inserted, to find
+        # duplicates. Reading them all back from disk for that would be worse
+        # than keeping them.
+        return self._sha1
+
+
+class _DiskInlineImage(InlineImage):
+    """An InlineImage that hands its bytes back to disk once it is placed."""
+
+    def _insert_image(self):
+        xml = super()._insert_image()
+        part = self.tpl.docx.part
+        for rid in re.findall(r'r:embed="([^"]+)"', xml):
+            image_part = part.related_parts[rid]
+            if isinstance(image_part, _DiskImagePart):
+                continue
+            sha1 = image_part.sha1
+            image_part.__class__ = _DiskImagePart
+            image_part._path = self.image_descriptor
+            image_part._sha1 = sha1
+            image_part._blob = None
+            image_part._image = None
+        return xml
+
+
+# How hard to deflate the XML parts of a saved report, 1 to 9. Six is zlib's
+# own default and what python-docx used for everything.
+ZIP_LEVEL = int(os.environ.get('REPORT_ZIP_LEVEL') or 6)
+
+# Media that is already compressed. Deflating a JPEG spends CPU to save a
+# fraction of a percent, and a report is mostly JPEGs; these are stored as they
+# are. Anything else in word/media -- EMF, BMP, TIFF -- still compresses well.
+_STORED_MEDIA = ('.jpeg', '.jpg', '.png', '.gif', '.webp')
+
+
+def _save_docx(doc, path):
+    """doc.save, but with photographs stored rather than deflated.
+
+    python-docx's writer deflates every part of the package the same way. This
+    walks the same parts in the same order -- content types, package rels, then
+    each part and its rels -- choosing per part. A part whose bytes are still on
+    disk (see _DiskImagePart) is copied from the file, so it is never in memory
+    whole.
+    """
+    doc.pre_processing()
+    package = doc.docx.part.package
+    for part in package.parts:
+        part.before_marshal()
+
+    with zipfile.ZipFile(
+        path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=ZIP_LEVEL
+    ) as zf:
+        zf.writestr(CONTENT_TYPES_URI.membername, _ContentTypesItem.from_parts(package.parts).blob)
+        zf.writestr(PACKAGE_URI.rels_uri.membername, package.rels.xml)
+        for part in package.parts:
+            name = part.partname.membername
+            stored = (
+                name.startswith('word/media/')
+                and os.path.splitext(name)[1].lower() in _STORED_MEDIA
+            )
+            compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+            if isinstance(part, _DiskImagePart):
+                zf.write(part._path, name, compress_type=compress_type)
+            else:
+                zf.writestr(name, part.blob, compress_type=compress_type)
+            if len(part.rels):
+                zf.writestr(part.partname.rels_uri.membername, part.rels.xml)
+
+    doc.post_processing(path)
+
+
+def _inline_image(doc, path, width):
+    """The picture for `path` at `width`, held the way this server is set to."""
+    if LEAN_RENDER:
+        return _DiskInlineImage(doc, path, width=width)
+    return InlineImage(doc, path, width=width)
+
+# Re-encodings a photograph can be taken down, mildest first, when a report has
+# to fit max_report_bytes: JPEG quality, then a fraction of the width it was
+# prepared at. Every step is progressive with optimised Huffman tables, which
+# alone takes a few percent off at no cost to the picture, and 4:2:0 chroma --
+# colour at half the resolution of brightness, which the eye does not miss in a
+# photograph of a hull.
+SIZE_LADDER = (
+    (80, 1.0),
+    (70, 1.0),
+    (60, 1.0),
+    (60, 0.8),
+    (50, 0.67),
+    (45, 0.5),
+    (40, 0.4),
+)
+
+
+def _size_budget(value):
+    """max_report_bytes as sent: None if it was not, an int if it makes sense,
+    ValueError if it does not."""
+    if value in (None, ''):
+        return None
+    budget = int(value)
+    if budget <= 0:
+        raise ValueError(value)
+    return budget
+
+
+def _reencode(blob, step):
+    """A JPEG's bytes re-encoded at one step of SIZE_LADDER."""
+    quality, scale = SIZE_LADDER[step]
+    with Image.open(io.BytesIO(blob)) as img:
+        picture = img.convert("RGB") if img.mode not in ("RGB", "L") else img
+        if scale < 1.0:
+            picture = picture.resize(
+                (max(1, int(img.width * scale)), max(1, int(img.height * scale))),
+                Image.LANCZOS,
+            )
+        out = io.BytesIO()
+        picture.save(
+            out, format='JPEG', quality=quality, optimize=True, progressive=True,
+            subsampling=2,
+        )
+        if picture is not img:
+            picture.close()
+    return out.getvalue()
+
+
+def _fit_to_budget(doc, budget, artwork=frozenset()):
+    """Re-encode a rendered report's photographs until it should save in under
+    `budget` bytes.
+
+    `artwork` is the part names of the images the template came with -- a
+    logo, a letterhead -- which are the firm's, not the survey's, and are
+    counted as they are and never re-encoded.
+
+    The photographs are most of a report, and their size was whatever the phone
+    and quality 85 made it. Everything that is not a JPEG is counted as it will
+    be saved and left alone. Then, for as long as the total is over, the largest
+    photograph goes one step down SIZE_LADDER from its prepared file -- so a few
+    big photographs pay for the budget before any small one is touched, and a
+    report already under it is not re-encoded at all. The size on the page does
+    not change; a photograph taken down in width is drawn from fewer pixels.
+
+    Only sizes are held while it works. A photograph's bytes are read when it
+    is taken down a step and let go after -- under lean rendering they stay on
+    disk until then, as they do until the save.
+    """
+    package = doc.docx.part.package
+    fixed = len(_ContentTypesItem.from_parts(package.parts).blob) + len(package.rels.xml)
+    photos = []
+    for part in package.parts:
+        name = part.partname.membername
+        # Local header and central directory entry, about.
+        fixed += 100 + 2 * len(name)
+        if len(part.rels):
+            fixed += len(zlib.compress(part.rels.xml, ZIP_LEVEL))
+        if (isinstance(part, ImagePart) and part.content_type == 'image/jpeg'
+                and part.partname not in artwork):
+            # The prepared file under lean rendering; otherwise nothing until
+            # the part's own bytes are replaced, and then those.
+            source = part._path if isinstance(part, _DiskImagePart) else None
+            photos.append({"part": part, "source": source, "size": _part_size(part), "step": -1})
+        elif name.startswith('word/media/'):
+            fixed += _part_size(part)
+        else:
+            fixed += len(zlib.compress(part.blob, ZIP_LEVEL))
+
+    total = fixed + sum(photo["size"] for photo in photos)
+    started, encoded = total, 0
+    # Held back for saving the report, and converting it if it is a PDF.
+    held_back = g._held_back - RENDER_BUDGET + 5
+    while total > budget:
+        left = [photo for photo in photos if photo["step"] < len(SIZE_LADDER) - 1]
+        if not left:
+            break
+        if _remaining() < held_back:
+            _degrade('size-fit-cut-short')
+            break
+        photo = max(left, key=lambda photo: photo["size"])
+        photo["step"] += 1
+        source = photo["source"]
+        if isinstance(source, str):
+            with open(source, 'rb') as handle:
+                source = handle.read()
+        elif source is None:
+            source = photo["part"].blob
+        smaller = _reencode(source, photo["step"])
+        encoded += 1
+        if len(smaller) < photo["size"]:
+            total -= photo["size"] - len(smaller)
+            photo["size"] = len(smaller)
+            if photo["source"] is None:
+                # Every step starts again from what was prepared, which the
+                # part is about to stop holding.
+                photo["source"] = source
+            _replace_image(photo["part"], smaller)
+        del source, smaller
+
+    if encoded:
+        print(
+            f"[🗜️] {encoded} re-encodings took the report from about "
+            f"{started / 1e6:.1f}MB to {total / 1e6:.1f}MB (budget {budget / 1e6:.1f}MB)",
+            flush=True,
+        )
+    metrics.count('size_budget_reencodes', encoded)
+    return total
+
+
+def _part_size(part):
+    """An image part's size in bytes, without reading one kept on disk."""
+    if isinstance(part, _DiskImagePart):
+        return os.path.getsize(part._path)
+    return len(part.blob)
+
+
+def _replace_image(part, blob):
+    """Give an image part new bytes, wherever it keeps them."""
+    if isinstance(part, _DiskImagePart):
+        path = _temp_file(".jpg")
+        with open(path, 'wb') as handle:
+            handle.write(blob)
+        part._path = path
+    else:
+        part._blob = blob
+
 
 # Shared secret with the app, sent as the X-Report-Key header on every
 # /generate_report call. Set on Render's dashboard, not committed here -- see
@@ -63,10 +752,12 @@ def _remove_temp_files(_error):
 # handed all of it to anyone who asked, with nothing to check who was asking.
 REPORT_API_KEY = os.environ.get('REPORT_API_KEY')
 
-# The only two templates this server has. `template` arrives on the form, and
-# without this it went straight into DocxTemplate with nothing checked -- an
-# unvalidated path, behind a key that ships inside every copy of the app. The
-# key is a shared secret at best; this is the part that does not depend on it.
+# The templates built into the image. `template` arrives on the form, and
+# without a whitelist it went straight into DocxTemplate with nothing checked --
+# an unvalidated path, behind a key that ships inside every copy of the app. The
+# key is a shared secret at best; the registry below, which knows these and
+# whatever has been added to REPORT_TEMPLATE_DIR by name and nothing else, is
+# the part that does not depend on it.
 TEMPLATES = (
     'survey_template_01a.docx',
     'survey_template_owner.docx',
@@ -84,6 +775,74 @@ def _report_key_is_valid(provided):
         return False
     return hmac.compare_digest(provided, REPORT_API_KEY)
 
+
+def _key_refusal():
+    """The response to send if this request's X-Report-Key is not good enough,
+    or None if it is."""
+    if _report_key_is_valid(request.headers.get('X-Report-Key')):
+        return None
+    if not REPORT_API_KEY:
+        print(
+            "[🔒] REPORT_API_KEY is not set on this server -- refusing "
+            "every request until it is. Set it on Render's dashboard.",
+            flush=True,
+        )
+        return {"error": "Server is not configured to accept report requests."}, 500
+    print(f"[🔒] Rejected {request.path}: missing or wrong X-Report-Key", flush=True)
+    return {"error": "Missing or invalid X-Report-Key."}, 401
+
+# Where to write the shape of each report request, one JSON line apiece, for
+# scripts/loadtest.py to replay. Unset means nothing is written. A shape is
+# counts and sizes only -- which fields came, how long each one was, how big
+# each photograph was -- and never what anything said or showed. The options
+# in survey.OPTIONS are kept as they were sent: they are settings, not
+# anything the owner wrote, and a replay needs them to ask for the same.
+SHAPE_LOG = os.environ.get('REPORT_SHAPE_LOG')
+
+
+def _record_shape(form, files, probes):
+    """Append this request's shape to SHAPE_LOG. A photograph's dimensions are
+    from `probes`, the headers _probe_photos has already read; one it did not
+    read, or could not, is 0 by 0."""
+    photos = []
+    for name, file in files.items():
+        found = probes.get(name)
+        photos.append({
+            "name": name,
+            "bytes": _upload_size(file),
+            "width": found.width if found else 0,
+            "height": found.height if found else 0,
+        })
+    for key, value in form.items():
+        if key.endswith('_base64'):
+            found = probes.get(key[:-len('_base64')] + '_photo')
+            photos.append({
+                "name": key,
+                "bytes": len(value) * 3 // 4,
+                "width": found.width if found else 0,
+                "height": found.height if found else 0,
+            })
+    shape = {
+        "template": form.get("template", "survey_template_01a.docx"),
+        "format": form.get("format", "docx").lower(),
+        "options": {
+            key: form[key] for key in OPTIONS
+            if key in form and key not in ('template', 'format')
+        },
+        "text": {
+            key: len(value) for key, value in form.items()
+            if not key.endswith('_base64') and key not in OPTIONS
+        },
+        "photos": photos,
+    }
+    # One write of one line in append mode, so two workers writing at once
+    # interleave whole lines rather than halves of them.
+    try:
+        with open(SHAPE_LOG, 'a', encoding='utf-8') as handle:
+            handle.write(json.dumps(shape) + "\n")
+    except OSError as e:
+        print(f"[⚠️] Could not record request shape: {e}", flush=True)
+
 # ---- Custom filters ----
 def nl2br(value):
     """Convert newlines into Word line breaks for docxtpl (kept for optional use)."""
@@ -100,16 +859,9 @@ def nl2br(value):
     return rt
 # --------------------------
 
-def _split_to_lines(value):
-    """
-    Split a newline-separated string into a clean list of non-empty lines.
-    Falls back to ['None Observed'] if there are no lines.
-    """
-    text = "" if value is None else str(value)
-    raw_lines = text.split('\n')
-    lines = [ln.strip() for ln in raw_lines if ln.strip()]
-    return lines if lines else ["None Observed"]
-
+# What Pillow calls the formats a photograph can go into the document as. Word
+# shows GIF and BMP as well, but nothing sends them and a JPEG is smaller.
+WORD_FORMATS = ('JPEG', 'PNG')
 
 
 def prepare_image(path, max_width=1200):
@@ -123,6 +875,11 @@ def prepare_image(path, max_width=1200):
     saying which way is up. Word ignores that tag, so a photo taken in portrait
     lands on the page on its side. exif_transpose rotates the pixels for real
     and drops the tag.
+
+    Anything Word cannot show -- HEIC, WebP, AVIF -- is always rewritten, as
+    JPEG, or PNG if it has transparency to keep. What a file is comes from its
+    contents: the suffix it was saved under is the phone's filename, and an
+    iPhone's "IMG_0042.JPG" is as often HEIC as not.
     """
     try:
         with Image.open(path) as img:
@@ -131,38 +888,365 @@ def prepare_image(path, max_width=1200):
             # back a new object either way and cannot be used as the answer.
             orientation = (img.getexif() or {}).get(274, 1)
             rotated = orientation not in (1, None)
+            word_can_show = img.format in WORD_FORMATS
+
+            if LEAN_RENDER and img.width > max_width:
+                # Let the JPEG decoder scale by a half or a quarter while it
+                # reads, so a twelve megapixel photograph is never a 36MB
+                # bitmap. Square, because a rotated photograph's width is its
+                # height now; the LANCZOS pass below still does the real resize.
+                img.draft('RGB', (max_width, max_width))
+
             upright = ImageOps.exif_transpose(img) if rotated else img
+            held = []
+            try:
+                if upright.width > max_width:
+                    ratio = max_width / upright.width
+                    new_height = int(upright.height * ratio)
+                    held.append(upright)
+                    upright = upright.resize((max_width, new_height), Image.LANCZOS)
+                elif not rotated and word_can_show:
+                    return path
 
-            if upright.width > max_width:
-                ratio = max_width / upright.width
-                new_height = int(upright.height * ratio)
-                upright = upright.resize((max_width, new_height), Image.LANCZOS)
-            elif not rotated:
-                return path
+                # The decoded photograph and its resized copy are both held
+                # here, which is as big as preparing one gets. Between
+                # photographs, where the checkpoints look, it is gone again.
+                _note_peak()
 
-            if upright.mode not in ("RGB", "L"):
-                upright = upright.convert("RGB")
+                if upright.has_transparency_data:
+                    if upright.mode not in ("RGBA", "LA"):
+                        held.append(upright)
+                        upright = upright.convert("RGBA")
+                    prepared = _temp_file(".png")
+                    upright.save(prepared, format='PNG')
+                    return prepared
 
-            prepared = _temp_file(".jpg")
-            upright.save(prepared, format='JPEG', quality=85)
-            return prepared
+                if upright.mode not in ("RGB", "L"):
+                    held.append(upright)
+                    upright = upright.convert("RGB")
+
+                prepared = _temp_file(".jpg")
+                upright.save(prepared, format='JPEG', quality=85)
+                return prepared
+            finally:
+                # Every step above makes a new bitmap and leaves the last one
+                # for the garbage collector. Closing them here frees them now,
+                # before the next photograph is opened, rather than whenever.
+                for image in held + [upright]:
+                    if image is not img:
+                        image.close()
+                if LEAN_RENDER:
+                    Image.core.clear_cache()
     except Exception as e:
         print(f"[⚠️] Image prepare failed for {path}: {e}", flush=True)
     return path
 
 
+# Where profiles of single reports are kept, and how many. A profile is asked
+# for with X-Report-Profile: 1 alongside a good key, and fetched afterwards
+# from /profiles/<id> with the same key. The oldest go once there are more
+# than PROFILE_KEEP, so a forgotten header cannot fill the disk.
+PROFILE_DIR = os.environ.get(
+    'REPORT_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'report-profiles')
+)
+PROFILE_KEEP = int(os.environ.get('REPORT_PROFILE_KEEP') or 50)
+
+# Every this many seconds the sampler looks at what the report's thread is
+# doing. Five milliseconds gives a few thousand samples over a typical report.
+PROFILE_INTERVAL = float(os.environ.get('REPORT_PROFILE_INTERVAL') or 0.005)
+
+PROFILE_ID = re.compile(r"^[0-9a-f]{16}$")
+
+
+class _StackSampler(threading.Thread):
+    """Samples one thread's stack until stopped, counting each distinct stack.
+
+    A sampler rather than cProfile because cProfile traces every call in every
+    thread while it is on, which would slow the other reports sharing this
+    worker as much as the one being looked at. This runs only while a profiled
+    report does, and looks only at that report's thread.
+    """
+
+    def __init__(self, thread_id):
+        super().__init__(daemon=True)
+        self._thread_id = thread_id
+        self._done = threading.Event()
+        self.counts = {}
+
+    def run(self):
+        while not self._done.wait(PROFILE_INTERVAL):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return self.counts
+
+
+def _save_profile(counts):
+    """Write collapsed stacks -- one "frame;frame;frame count" line each, the
+    format flamegraph.pl and speedscope both read -- and return the id."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profile_id = uuid.uuid4().hex[:16]
+    path = os.path.join(PROFILE_DIR, f"{profile_id}.folded")
+    with open(path, 'w', encoding='utf-8') as handle:
+        for stack, count in sorted(counts.items()):
+            handle.write(f"{stack} {count}\n")
+
+    kept = sorted(
+        (os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR)
+         if name.endswith('.folded')),
+        key=os.path.getmtime,
+    )
+    for old in kept[:-PROFILE_KEEP]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+    return profile_id
+
+
+def _profiled(build):
+    """Run `build` for this request under the stack sampler."""
+    sampler = _StackSampler(threading.get_ident())
+    sampler.start()
+    try:
+        response = make_response(build())
+    finally:
+        counts = sampler.stop()
+        profile_id = _save_profile(counts)
+        print(
+            f"[🔬] Profiled this report: {sum(counts.values())} samples, id {profile_id}",
+            flush=True,
+        )
+    response.headers['X-Report-Profile-Id'] = profile_id
+    return response
+
+
+@app.route('/profiles/<profile_id>')
+def profile(profile_id):
+    refusal = _key_refusal()
+    if refusal is not None:
+        return refusal
+    path = os.path.join(PROFILE_DIR, f"{profile_id}.folded")
+    if not PROFILE_ID.match(profile_id) or not os.path.exists(path):
+        return {"error": "No such profile."}, 404
+    return send_file(path, mimetype='text/plain', download_name=f"{profile_id}.folded")
+
+
+metrics = Metrics()
+
+# Bodies sent with Content-Encoding: gzip or zstd are decompressed as they are
+# read, and count against the size limits at what they decompress to.
+app.wsgi_app = DecompressingMiddleware(app.wsgi_app, metrics)
+
+
+@app.errorhandler(BadBody)
+def _report_bad_body(error):
+    print(f"[📦] Refused a body: {error.description}", flush=True)
+    return {"error": error.description}, 400
+
+
+# Prepared photographs and finished reports, kept where every instance can find
+# them. Unset, nothing is kept. A file:// URL keeps them on this instance's
+# disk, under REPORT_CACHE_MAX_MB in all; a redis:// URL keeps them in a Redis
+# the instances share, whose own maxmemory decides how much. Either way an
+# entry lasts REPORT_CACHE_TTL seconds, and nothing over REPORT_CACHE_ITEM_MB is
+# kept at all.
+CACHE_TTL = int(os.environ.get('REPORT_CACHE_TTL') or 24 * 60 * 60)
+CACHE_MAX_MB = int(os.environ.get('REPORT_CACHE_MAX_MB') or 512)
+CACHE_ITEM_MB = int(os.environ.get('REPORT_CACHE_ITEM_MB') or 32)
+
+_shared_cache = open_cache(
+    os.environ.get('REPORT_CACHE_URL'),
+    metrics,
+    ttl=CACHE_TTL,
+    max_bytes=CACHE_MAX_MB * 1024 * 1024,
+    max_item_bytes=CACHE_ITEM_MB * 1024 * 1024,
+)
+
+# A report is only the same report if what built it is the same: every module
+# that shapes it and the libraries under them. A deploy that changes any of
+# these starts the reports afresh rather than serving what the last one built.
+# Settings that change what comes out -- lean rendering, the zip level, PDFs in
+# parts -- go in each key, in _report_key.
+OUTPUT_MODULES = ('app.py', 'survey.py', 'sections.py', 'probe.py')
+OUTPUT_LIBRARIES = ('docxtpl', 'python-docx', 'Pillow', 'pillow-heif', 'pypdf')
+
+
+def _code_version():
+    digest = hashlib.sha1()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in OUTPUT_MODULES:
+        with open(os.path.join(here, name), 'rb') as source:
+            digest.update(name.encode() + b"\0" + source.read())
+    for library in OUTPUT_LIBRARIES:
+        try:
+            version = importlib.metadata.version(library)
+        except importlib.metadata.PackageNotFoundError:
+            version = None
+        digest.update(f"{library}={version}\0".encode())
+    return digest.hexdigest()
+
+
+CODE_VERSION = _code_version()
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _prepare_shared(path, width, digest=None):
+    """prepare_image, by way of the shared cache when there is one.
+
+    A photograph prepared elsewhere comes back as bytes, written to a temporary
+    file of this report's own. One that needed nothing doing is kept as
+    nothing, which says so, rather than as a second copy of itself.
+    """
+    if _shared_cache is None:
+        return prepare_image(path, max_width=width)
+    key = f"{digest or _file_digest(path)}-{width}-{int(LEAN_RENDER)}-{CODE_VERSION[:12]}"
+    kept = _shared_cache.get('photo', key)
+    if kept is not None:
+        if not kept:
+            return path
+        ready = _temp_file(".png" if kept.startswith(b"\x89PNG") else ".jpg")
+        with open(ready, 'wb') as handle:
+            handle.write(kept)
+        return ready
+
+    ready = prepare_image(path, max_width=width)
+    if ready == path:
+        _shared_cache.set('photo', key, b"")
+    else:
+        with open(ready, 'rb') as handle:
+            _shared_cache.set('photo', key, handle.read())
+    return ready
+
+
+def _report_key(form, files, requested_format, template):
+    """What a report depends on, as one digest: the code, the settings that
+    change what it builds, the template, the format, every field and every
+    uploaded file."""
+    digest = hashlib.sha1()
+    digest.update(json.dumps([
+        CODE_VERSION,
+        {"lean": LEAN_RENDER, "zip_level": ZIP_LEVEL, "pdf_split": PDF_SPLIT},
+        template.digest, requested_format, sorted(form.items()),
+    ]).encode())
+    for name in sorted(files):
+        stream = files[name].stream
+        digest.update(f"\0{name}\0".encode())
+        stream.seek(0)
+        for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+            digest.update(chunk)
+        # It is saved from where it was left.
+        stream.seek(0)
+    return digest.hexdigest()
+
+
+# How many reports this worker builds at once, and what each client may have.
+# Set fewer slots than gunicorn has threads: a thread waiting here holds a
+# request whose upload has already arrived, which costs little, and the wait is
+# where the fairness happens. With as many slots as threads nothing ever waits
+# here, and requests queue in gunicorn's backlog first come first served.
+RENDER_SLOTS = int(os.environ.get('REPORT_RENDER_SLOTS') or 2)
+CLIENT_CONCURRENCY = int(os.environ.get('REPORT_CLIENT_CONCURRENCY') or 1)
+CLIENT_QUEUE = int(os.environ.get('REPORT_CLIENT_QUEUE') or 4)
+
+# How much memory, in megabytes, the reports being built at once in this worker
+# may be estimated to need between them. Unset, only the slots limit them. Two
+# ordinary surveys fit in a couple of hundred; a survey of 48 megapixel HEICs
+# then waits for the room rather than taking the worker past its memory.
+RENDER_MEMORY_MB = int(os.environ.get('REPORT_RENDER_MEMORY_MB') or 0)
+
+_scheduler = FairScheduler(
+    slots=RENDER_SLOTS,
+    per_client=CLIENT_CONCURRENCY,
+    queue_length=CLIENT_QUEUE,
+    weights=parse_weights(os.environ.get('REPORT_CLIENT_WEIGHTS')),
+    memory=RENDER_MEMORY_MB * 1024 * 1024,
+)
+
+
+@app.errorhandler(QueueFull)
+def _queue_full(error):
+    print(f"[🚦] Refused a report from {error}: its queue is full", flush=True)
+    metrics.count('queue_refused')
+    response = make_response({"error": "Too many reports waiting. Try again shortly."}, 429)
+    response.headers['Retry-After'] = '30'
+    return response
+
+
+@app.errorhandler(QueueTimeout)
+def _queue_timeout(error):
+    print(f"[🚦] A report from {error} waited past its deadline", flush=True)
+    metrics.count('queue_timeout')
+    return {"error": "The server is too busy to build that report. Try again shortly."}, 503
+
+
+@app.errorhandler(Abandoned)
+def _queue_abandoned(error):
+    metrics.count('queue_abandoned')
+    return _report_abandoned(f"while queued ({error})")
+
+
+def _client_id():
+    """Who this report is for, as far as fair shares go.
+
+    X-Report-Client is the app's name for the account sending it. Without one,
+    the address it came from, which on Render is the first hop in
+    X-Forwarded-For -- the connection itself is always Render's proxy.
+    """
+    client = request.headers.get('X-Report-Client', '').strip()[:64]
+    if client:
+        return client
+    forwarded = request.headers.get('X-Forwarded-For', '').split(',')[0].strip()
+    return forwarded or request.remote_addr or 'unknown'
+
+
+@app.route('/metrics')
+def metrics_view():
+    refusal = _key_refusal()
+    if refusal is not None:
+        return refusal
+    return {
+        "metrics": metrics.snapshot(),
+        "scheduler": _scheduler.snapshot(),
+        "convert": _converter.snapshot(),
+        "templates": _templates.snapshot(),
+    }
+
+
 @app.route('/generate_report', methods=['POST'])
 def generate_report():
-    if not _report_key_is_valid(request.headers.get('X-Report-Key')):
-        if not REPORT_API_KEY:
-            print(
-                "[🔒] REPORT_API_KEY is not set on this server -- refusing "
-                "every request until it is. Set it on Render's dashboard.",
-                flush=True,
-            )
-            return {"error": "Server is not configured to accept report requests."}, 500
-        print("[🔒] Rejected /generate_report: missing or wrong X-Report-Key", flush=True)
-        return {"error": "Missing or invalid X-Report-Key."}, 401
+    refusal = _key_refusal()
+    if refusal is not None:
+        return refusal
+
+    # Asked for only after the key has been checked, so nobody without it can
+    # make the server spend time profiling or fill its disk with profiles.
+    if request.headers.get('X-Report-Profile') == '1':
+        return _profiled(_build_report)
+    return _build_report()
+
+
+def _build_report():
+    _start_deadline()
 
     form = request.form.to_dict()
     files = request.files
@@ -172,183 +1256,994 @@ def generate_report():
 
     requested_format = form.get("format", "docx").lower()
     template_name = form.get("template", "survey_template_01a.docx")
-    if template_name not in TEMPLATES:
+    # Taken once: a newer version swapped in from here on is for the next
+    # report, not the rest of this one.
+    template = _templates.get(template_name)
+    if template is None:
         print(f"[🚫] Refused unknown template: {template_name!r}", flush=True)
         return {"error": "Unknown template."}, 400
+    try:
+        g._size_budget = _size_budget(form.get("max_report_bytes"))
+    except ValueError:
+        return {"error": "max_report_bytes must be a whole number of bytes."}, 400
 
-    doc = DocxTemplate(template_name)
+    g._survey = parse_survey(form, files)
+    g._probes = _probe_photos(g._survey)
+    if SHAPE_LOG:
+        _record_shape(form, files, g._probes)
+    body, mimetype, download_name = _produce(
+        form, files, requested_format, template, _client_id()
+    )
+    return send_file(
+        io.BytesIO(body),
+        as_attachment=True,
+        download_name=download_name,
+        mimetype=mimetype,
+    )
 
-    # Base context: all non-file, non-photo-path fields
-    context = {
-        k: v for k, v in form.items()
-        if not k.endswith('_photo') and not k.endswith('_photo_path') and not k.endswith('_base64') and k != 'template' and k != 'format'
-    }
 
-    # A finding's photograph, which the severity loops further down place
-    # beside its text. Named <severity>_finding_<n>_photo.
-    FINDING_PHOTO = re.compile(r"^(aa|a|b|c|monitor|ftr)_finding_\d+_photo")
-
-    # Resolve image keys from either of *_photo, *_base64
-    image_keys = set()
-    for key in list(form.keys()) + list(files.keys()):
-        # Findings photographs are handled with their findings, not as
-        # standalone placeholders. Without this they would be decoded and
-        # resized twice, and land in the context under a name no template has.
-        if FINDING_PHOTO.match(key):
-            continue
-        # No _photo_path here any more. It named a file for the server to read
-        # off its own disk, and the app never sends one -- it strips those and
-        # re-sends each as an uploaded file. So the only caller it could ever
-        # have served was one poking at the endpoint.
-        if key.endswith('_photo') or key.endswith('_base64'):
-            base = key.replace('_photo', '').replace('_base64', '')
-            image_keys.add(base)
-
-    print(f"[🔎] Found image_keys: {image_keys}", flush=True)
-
-    # Attach images into context
-    for base in image_keys:
-        field_name = base + '_photo'
-        print(f"[🔄] Evaluating field: {field_name}", flush=True)
-
-        if field_name in files:
-            print(f"[🖼️] Using uploaded file for {field_name}", flush=True)
-            file = files[field_name]
-            temp_path = _temp_file(os.path.splitext(file.filename)[1])
-            file.save(temp_path)
-
-            temp_path = prepare_image(temp_path)
-            context[field_name] = InlineImage(doc, temp_path, width=Inches(4.5))
-
-        elif base + '_base64' in form:
-            print(f"[🧬] Decoding base64 for {field_name}", flush=True)
-            try:
-                data = base64.b64decode(form[base + '_base64'])
-                temp_path = _temp_file(".jpg")
-                with open(temp_path, 'wb') as handle:
-                    handle.write(data)
-                temp_path = prepare_image(temp_path)
-                context[field_name] = InlineImage(doc, temp_path, width=Inches(4.5))
-            except Exception as e:
-                print(f"[⚠️] Failed to decode base64 for {field_name}: {e}", flush=True)
-
-    # Build arrays for severity loops in the template.
-    #
-    # "monitor" is not a professional survey grade. It means watch this, which
-    # is what an owner writes down most of the time -- 43 of the 56 findings on
-    # SV Liquid are monitor. Without it the report omits three quarters of what
-    # a walk turned up. Harmless on the older template, which has no block to
-    # loop over it; the owner template has one.
-    for sev in ("aa", "a", "b", "c", "monitor", "ftr"):
-        key = f"{sev}_findings"
-        lines = _split_to_lines(context.get(key))
-        context[f"{sev}_findings_list"] = lines
-
-        # The same findings, each able to carry a photograph.
-        #
-        # Two shapes rather than one because the older professional template
-        # loops over plain strings and still has to work. The owner template
-        # loops over these instead.
-        #
-        # A finding without a photograph is an assertion; with one it is
-        # evidence. That is the whole reason for this.
-        items = []
-        for n, text in enumerate(lines, start=1):
-            photo = ""
-            field = f"{sev}_finding_{n}_photo"
-            if field in files:
-                uploaded = files[field]
-                saved = _temp_file(
-                    os.path.splitext(uploaded.filename)[1] or ".jpg"
-                )
-                uploaded.save(saved)
-                ready = prepare_image(saved)
-                # Narrower than the walk-round photographs at 4.5". A finding
-                # photograph is a detail shot sitting under one line of text,
-                # not a plate.
-                photo = InlineImage(doc, ready, width=Inches(3.0))
-                print(f"[📸] {field} attached", flush=True)
-            items.append({"text": text, "photo": photo})
-        context[f"{sev}_findings_items"] = items
+DOCX_MIMETYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
 
-    # Debug: verify counts incl. FTR
-    print("[lists] aa:", len(context.get("aa_findings_list", [])),
-          "a:", len(context.get("a_findings_list", [])),
-          "monitor:", len(context.get("monitor_findings_list", [])),
-          "b:", len(context.get("b_findings_list", [])),
-          "c:", len(context.get("c_findings_list", [])),
-          "ftr:", len(context.get("ftr_findings_list", [])),
-          flush=True)
+
+def _produce(form, files, requested_format, template, client, limit=None):
+    """One report, start to finish: wait for a render slot, render, and convert
+    if asked. Returns (bytes, mimetype, download name).
+
+    A report already built from exactly the same survey comes from the shared
+    cache instead, without waiting for anything -- which is what happens when
+    the app times out on a large survey and sends it again.
+    """
+    key = None
+    if _shared_cache is not None:
+        key = _report_key(form, files, requested_format, template)
+        kept = _shared_cache.get('report', key)
+        if kept is not None:
+            g._cached = True
+            g._queue_wait = 0.0
+            print(f"[🗄️] Report {key[:12]} came from the cache", flush=True)
+            return _reported(kept)
+
+    body, mimetype, download_name = _build(form, files, requested_format, template, client, limit)
+    # A report cut short in any way is not the report this survey makes when
+    # there is time, and is not kept as if it were.
+    if key is not None and not g._degraded:
+        _shared_cache.set('report', key, body)
+    return body, mimetype, download_name
+
+
+def _reported(body):
+    """(bytes, mimetype, download name) for a finished report."""
+    if body.startswith(b"%PDF"):
+        return _within_budget(body), "application/pdf", "report.pdf"
+    return _within_budget(body), DOCX_MIMETYPE, "report.docx"
+
+
+def _build(form, files, requested_format, template, client, limit):
+    g._memory_estimate = _memory_estimate(g._survey, g._probes, template.names)
+    with _scheduler.slot(
+        client, timeout=_remaining(), still_wanted=_client_connected, limit=limit,
+        cost=g._memory_estimate,
+    ) as waited:
+        g._queue_wait = waited
+        metrics.observe('queue_wait_seconds', waited)
+        if waited > 1:
+            print(f"[🚦] {client} waited {waited:.1f}s for a slot", flush=True)
+        docx_path = _render_report(form, files, requested_format, template)
+
+    # The render slot is free again before any conversion starts, so the next
+    # report can be rendered while this one waits on LibreOffice.
+    body = None
+    if requested_format == "pdf":
+        body = _convert_to_pdf(docx_path)
+
+    # Default/Docx return path (or PDF fallback)
+    if body is None:
+        with open(docx_path, "rb") as f:
+            body = f.read()
+    _log_memory()
+    return _reported(body)
+
+
+def _log_memory():
+    """Log this report's peak growth beside its estimate, with the report
+    itself now in memory to be sent."""
+    _note_peak()
+    if getattr(g, '_rss_peak', None) is None:
+        return
+    grown_mb = (g._rss_peak - g._rss_start) / (1024 * 1024)
+    estimate_mb = g._memory_estimate / (1024 * 1024)
+    print(f"[🧠] Peak memory growth for this report: {grown_mb:.0f}MB, "
+          f"estimated {estimate_mb:.0f}MB", flush=True)
+    metrics.observe('memory_estimate_ratio', grown_mb / estimate_mb)
+
+
+def _within_budget(body):
+    """Note what size the report came to, and whether that was too big."""
+    g._report_bytes = len(body)
+    budget = getattr(g, '_size_budget', None)
+    if budget is not None and len(body) > budget:
+        # Photographs can only go so small; a report that is mostly text, or a
+        # PDF LibreOffice made bigger, can still be over.
+        _degrade('over-size-budget')
+    return body
 
 
+def _jinja_env():
     # Jinja environment (nl2br available for other fields if you want)
     env = Environment(autoescape=True)
     env.filters["nl2br"] = nl2br
+    return env
 
-    # Render with context and custom env
-    doc.render(context, jinja_env=env)
 
-    # Save and optionally convert to PDF
-    with tempfile.TemporaryDirectory() as temp_dir:
-        docx_path = os.path.join(temp_dir, "report.docx")
-        doc.save(docx_path)
-        print(f"[💾] DOCX saved to: {docx_path}", flush=True)
+class _LoadedTemplate:
+    """A template file read once, for any number of reports.
+
+    docxtpl renders a report by serialising the template's XML, cleaning up the
+    tags Word splits placeholders across, and compiling what is left as a Jinja
+    template. The last two come out the same for every report from the same
+    file, and for a template this size they are most of a second. The registry
+    keeps one of these for each template and warms it when it is taken in, so
+    no report pays for them at all.
+    """
+
+    def __init__(self, path):
+        self.name = os.path.basename(path)
+        with open(path, 'rb') as handle:
+            self.blob = handle.read()
+        self.digest = hashlib.sha1(self.blob).hexdigest()
+        self.env = _jinja_env()
+        self.patched = {}
+        self.compiled = {}
+        # Every name the template refers to, once warm. None until then, which
+        # the survey takes as "could be anything".
+        self.names = None
+
+    def open(self):
+        return _SharedTemplate(self)
+
+    def warm(self):
+        """Clean and compile the body, headers and footers now. A template
+        Jinja cannot compile raises here."""
+        doc = self.open()
+        sources = [doc.get_xml()]
+        for uri in (doc.HEADER_URI, doc.FOOTER_URI):
+            sources.extend(xml for _key, xml in doc.get_headers_footers_xml(uri))
+        names = set()
+        for xml in sources:
+            patched = doc.patch_xml(xml)
+            doc.compiled(patched)
+            names |= meta.find_undeclared_variables(self.env.parse(patched))
+        self.names = frozenset(names)
+        return self
+
+
+class _SharedTemplate(DocxTemplate):
+    """A DocxTemplate that keeps its cleaned and compiled XML in the
+    _LoadedTemplate it came from, keyed by the XML it started as."""
+
+    def __init__(self, loaded):
+        super().__init__(io.BytesIO(loaded.blob))
+        self._loaded = loaded
+
+    def patch_xml(self, src_xml):
+        patched = self._loaded.patched.get(src_xml)
+        if patched is None:
+            patched = super().patch_xml(src_xml)
+            self._loaded.patched[src_xml] = patched
+        return patched
+
+    def compiled(self, src_xml):
+        template = self._loaded.compiled.get(src_xml)
+        if template is None:
+            template = self._loaded.env.from_string(src_xml.replace('<w:p>', '\n<w:p>'))
+            self._loaded.compiled[src_xml] = template
+        return template
+
+    def render_xml(self, src_xml, context, jinja_env=None):
+        # docxtpl's own render_xml, less the from_string on every call. Its
+        # docx_context is kept: the lines of the document around a template
+        # error, which is how whoever exported the template finds it.
+        try:
+            dst_xml = self.compiled(src_xml).render(context)
+        except TemplateError as exc:
+            if getattr(exc, 'lineno', None) is not None:
+                lines = src_xml.replace('<w:p>', '\n<w:p>').splitlines()
+                line_number = max(exc.lineno - 4, 0)
+                exc.docx_context = [
+                    re.sub(r'<[^>]+>', '', line)
+                    for line in lines[line_number:line_number + 7]
+                ]
+            raise
+        dst_xml = dst_xml.replace('\n<w:p>', '<w:p>')
+        return (dst_xml
+                .replace('{_{', '{{')
+                .replace('}_}', '}}')
+                .replace('{_%', '{%')
+                .replace('%_}', '%}'))
 
-        if requested_format == "pdf":
-            pdf_path = os.path.join(temp_dir, "report.pdf")
+
+def _template_rules():
+    """scripts/check_template.py, the rules a template export has to pass."""
+    spec = importlib.util.spec_from_file_location(
+        'check_template', os.path.join(os.path.dirname(__file__), 'scripts', 'check_template.py')
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+_check_template = _template_rules()
+
+
+def _template_problems(path):
+    try:
+        return _check_template.problems(_check_template.read(path))[0]
+    except (OSError, zipfile.BadZipFile) as e:
+        return [f"it is not a DOCX: {e}"]
+
+
+# A fixed template export goes into REPORT_TEMPLATE_DIR rather than a deploy.
+# The directory is looked at every REPORT_TEMPLATE_POLL seconds. See
+# registry.py for what is checked before one is used.
+TEMPLATE_DIR = os.environ.get('REPORT_TEMPLATE_DIR')
+TEMPLATE_POLL = float(os.environ.get('REPORT_TEMPLATE_POLL') or 30)
+
+_templates = TemplateRegistry(
+    {name: os.path.join(os.path.dirname(os.path.abspath(__file__)), name) for name in TEMPLATES},
+    load=lambda path: _LoadedTemplate(path).warm(),
+    check=_template_problems,
+    directory=TEMPLATE_DIR,
+    interval=TEMPLATE_POLL,
+)
+_templates.start()
+
+
+def _survey_context(survey, place, names=None):
+    """The context a survey is rendered with, from its parsed Survey.
+
+    `place(field, path, width)` turns the photograph for `field`, saved to
+    `path`, into what goes in the context, to be shown `width` wide: a picture in the document for a
+    report, a thumbnail for a preview. Everything else -- which fields are
+    text, how findings are split and matched to their photographs -- is the
+    same for both, so a preview shows what the report will. `names` is what the
+    template refers to, so that only the shapes of findings it uses are made.
+    """
+    def saved(photo, width):
+        field = photo.field
+        print(f"[🔄] Evaluating field: {field}", flush=True)
+        if photo.file is not None:
+            print(f"[🖼️] Using uploaded file for {field}", flush=True)
+            path = _temp_file(os.path.splitext(photo.file.filename)[1] or ".jpg")
+            photo.file.save(path)
+            placed = place(field, path, Inches(width))
+        else:
+            print(f"[🧬] Decoding base64 for {field}", flush=True)
             try:
-                result = subprocess.run(
-                    [
-                        "libreoffice",
-                        "--headless",
-                        "--convert-to", "pdf",
-                        "--outdir", temp_dir,
-                        docx_path
-                    ],
-                    capture_output=True,
-                    text=True,
-                    # Without this a LibreOffice that hangs holds the worker
-                    # until Render kills the whole instance. Two minutes is
-                    # well past any real conversion.
-                    timeout=120,
-                )
+                data = base64.b64decode(photo.base64)
+                path = _temp_file(".jpg")
+                with open(path, 'wb') as handle:
+                    handle.write(data)
+                del data
+                placed = place(field, path, Inches(width))
+            except Exception as e:
+                print(f"[⚠️] Failed to decode base64 for {field}: {e}", flush=True)
+                placed = None
+        _checkpoint(field)
+        return placed
+
+    return survey.context(saved, names)
+
+
+# Appendix mode, asked for with photo_appendix=1. The walk-round photographs
+# are composited server-side into captioned grids, a page each, added after the
+# rest of the report. A document with two or three page-sized pictures lays out
+# and converts in a fraction of the time one with a dozen separate ones does.
+# The vessel's portrait and the signature stay where the template puts them.
+APPENDIX_INLINE = ('vessel', 'signature')
+APPENDIX_COLUMNS = 2
+APPENDIX_ROWS = 3
 
-                print("[📄] LibreOffice stdout:\n", result.stdout, flush=True)
-                print("[⚠️] LibreOffice stderr:\n", result.stderr, flush=True)
+# Sheets are drawn at this many pixels to the inch of the page they fill.
+APPENDIX_DPI = 200
 
-                if result.returncode != 0:
-                    raise RuntimeError(f"LibreOffice conversion failed: {result.stderr}")
 
-                if not os.path.exists(pdf_path):
-                    raise FileNotFoundError(f"Expected PDF not found at {pdf_path}")
+def _append_contact_sheets(doc, photos):
+    """Add `photos`, as (caption, path), to the end of the rendered report on
+    contact sheets that fill the page."""
+    document = doc.docx
+    section = document.sections[-1]
+    width = section.page_width - section.left_margin - section.right_margin
+    # Short of the full height, for the line the picture sits on.
+    height = int((section.page_height - section.top_margin - section.bottom_margin) * 0.9)
+    size = (int(width / 914400 * APPENDIX_DPI), int(height / 914400 * APPENDIX_DPI))
 
-                # 🔐 Read into memory BEFORE leaving the temp_dir context
-                with open(pdf_path, "rb") as f:
-                    pdf_bytes = f.read()
+    per_sheet = APPENDIX_COLUMNS * APPENDIX_ROWS
+    for start in range(0, len(photos), per_sheet):
+        sheet = _contact_sheet(photos[start:start + per_sheet], size)
+        paragraph = document.add_paragraph()
+        paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
+        run = paragraph.add_run()
+        # The break and the picture share a run, so the sheet starts the new
+        # page rather than sitting a blank line down it.
+        run.add_break(WD_BREAK.PAGE)
+        run.add_picture(sheet, width=width)
+    print(f"[🗂️] {len(photos)} photographs on {-(-len(photos) // per_sheet)} sheets", flush=True)
 
-                print(f"[✅] PDF generated: {pdf_path}", flush=True)
-                return send_file(
-                    io.BytesIO(pdf_bytes),
-                    as_attachment=True,
-                    download_name="report.pdf",
-                    mimetype="application/pdf",
+
+def _contact_sheet(photos, size):
+    """One sheet: a grid of photographs, each captioned, on white. Returns the
+    path of the JPEG."""
+    width, height = size
+    gutter = width // 40
+    caption = max(height // 40, 16)
+    font = _caption_font(int(caption * 0.8))
+    tile_width = (width - gutter * (APPENDIX_COLUMNS + 1)) // APPENDIX_COLUMNS
+    tile_height = (height - gutter * (APPENDIX_ROWS + 1)) // APPENDIX_ROWS - caption
+
+    canvas = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(canvas)
+    try:
+        for n, (label, path) in enumerate(photos):
+            x = gutter + (n % APPENDIX_COLUMNS) * (tile_width + gutter)
+            y = gutter + (n // APPENDIX_COLUMNS) * (tile_height + caption + gutter)
+            try:
+                with Image.open(path) as img:
+                    img.draft('RGB', (tile_width, tile_height))
+                    tile = img.convert("RGB")
+                tile.thumbnail((tile_width, tile_height), Image.LANCZOS)
+                canvas.paste(
+                    tile,
+                    (x + (tile_width - tile.width) // 2, y + (tile_height - tile.height) // 2),
                 )
+                tile.close()
             except Exception as e:
-                print(f"[❌] PDF generation failed: {e}. Falling back to DOCX.", flush=True)
-                # fall through to DOCX return below
+                print(f"[⚠️] Could not place {label} on a sheet: {e}", flush=True)
+            draw.text(
+                (x + tile_width // 2, y + tile_height + caption // 2),
+                label, fill="black", font=font, anchor="mm",
+            )
+        # A last sheet with rows to spare ends under its last row, rather than
+        # carrying a page of white.
+        rows = -(-len(photos) // APPENDIX_COLUMNS)
+        used = canvas.crop((0, 0, width, min(height, rows * (tile_height + caption + gutter) + gutter)))
+        path = _temp_file(".jpg")
+        used.save(path, format='JPEG', quality=85)
+        used.close()
+    finally:
+        canvas.close()
+    return path
 
-        # Default/Docx return path (or PDF fallback)
-        with open(docx_path, "rb") as f:
-            docx_bytes = f.read()
 
-        return send_file(
-            io.BytesIO(docx_bytes),
-            as_attachment=True,
-            download_name="report.docx",
-            mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+def _caption_font(size):
+    try:
+        return ImageFont.truetype("DejaVuSans.ttf", size)
+    except OSError:
+        # Pillow's own font, which it can draw at any size with FreeType.
+        return ImageFont.load_default(size)
+
+
+def _render_report(form, files, requested_format, template):
+    """Build the report as a DOCX from a _LoadedTemplate and return its path.
+    Runs holding one of the scheduler's slots."""
+    g._rss_start = _rss_bytes()
+    doc = template.open()
+    # The template's own pictures, before any of the survey's are added.
+    artwork = {
+        part.partname for part in doc.docx.part.package.parts
+        if isinstance(part, ImagePart)
+    }
+
+    survey = g._survey
+    walk_round = {photo.field for photo in survey.photos}
+    print(f"[🔎] Found image_keys: {[photo.base for photo in survey.photos]}", flush=True)
+
+    probes = g._probes
+    _plan_photos(
+        sum(_photo_seconds(probes.get(field)) for field in survey.photo_fields(template.names)),
+        pdf=requested_format == "pdf",
+    )
+
+    # In appendix mode the walk-round photographs go on contact sheets at the
+    # end, and each placeholder says which sheet to look on.
+    appendix = survey.options.get('photo_appendix') == '1'
+    sheet_photos = []
+
+    def place(field, path, width):
+        base = field[:-len('_photo')]
+        if appendix and field in walk_round and base not in APPENDIX_INLINE:
+            sheet_photos.append((_label(base), _prepare_photo(path, probes.get(field))))
+            sheet = (len(sheet_photos) - 1) // (APPENDIX_COLUMNS * APPENDIX_ROWS) + 1
+            return f"See photograph sheet {sheet}."
+        return _inline_image(doc, _prepare_photo(path, probes.get(field)), width)
+
+    context = _survey_context(survey, place, template.names)
+
+    # Debug: verify counts incl. FTR
+    print("[lists]", " ".join(f"{sev}: {len(survey.lines(sev))}" for sev in SEVERITIES), flush=True)
+
+
+    # Render with context and custom env
+    doc.render(context, jinja_env=template.env)
+    _checkpoint("render")
+
+    if sheet_photos:
+        _append_contact_sheets(doc, sheet_photos)
+        _checkpoint("appendix")
+
+    budget = getattr(g, '_size_budget', None)
+    if budget is not None:
+        _fit_to_budget(doc, budget, artwork)
+        _checkpoint("fit")
+
+    docx_path = os.path.join(_temp_dir(), "report.docx")
+    _save_docx(doc, docx_path)
+    print(f"[💾] DOCX saved to: {docx_path}", flush=True)
+    _checkpoint("save")
+    return docx_path
+
+
+# Conversions run on their own threads, this many at once in each worker. One,
+# because LibreOffice takes a couple of hundred megabytes of its own, and
+# because a second conversion on the free instance's one CPU makes both slower.
+CONVERT_WORKERS = int(os.environ.get('REPORT_CONVERT_WORKERS') or 1)
+
+# PDFs allowed to be waiting for a converter. Each one waiting holds a request
+# thread, and a worker that had every thread waiting here could not take the
+# DOCX requests the separate lane exists for. Past this, a PDF request gets its
+# DOCX straight away and says so in X-Report-Degraded.
+CONVERT_QUEUE = int(os.environ.get('REPORT_CONVERT_QUEUE') or 2)
+
+_converter = Lane('convert', CONVERT_WORKERS)
+
+
+# Convert a report as this many parts at once, each on its own LibreOffice, and
+# join the PDFs. One, the default, converts it whole. Each LibreOffice takes a
+# couple of hundred megabytes, so more than one is for an instance with the
+# memory and the cores for it; see sections.py for where a report is cut.
+PDF_SPLIT = int(os.environ.get('REPORT_PDF_SPLIT') or 1)
+
+# LibreOffice profiles, one to each LibreOffice running. Two LibreOffices
+# sharing a profile do not both convert -- the second hands its file to the
+# first and exits -- and that is as true of two converter threads, or two
+# gunicorn workers, converting whole reports as of the parts of one. So every
+# conversion borrows one of these; the names carry the process's id. They are
+# kept for the next report: making a new profile costs a LibreOffice a few
+# seconds before it converts anything.
+_lo_profiles = []
+_lo_profiles_lock = threading.Lock()
+_lo_profiles_made = 0
+
+
+def _borrow_profile():
+    global _lo_profiles_made
+    with _lo_profiles_lock:
+        if _lo_profiles:
+            return _lo_profiles.pop()
+        _lo_profiles_made += 1
+        return os.path.join(
+            tempfile.gettempdir(), f"report-lo-{os.getpid()}-{_lo_profiles_made}"
         )
 
 
+def _return_profile(path):
+    with _lo_profiles_lock:
+        _lo_profiles.append(path)
+
+
+def _libreoffice(docx_path, deadline, still_wanted, profile=None):
+    """Run LibreOffice on one DOCX and return the path of its PDF, beside it."""
+    out_dir = os.path.dirname(docx_path)
+    pdf_path = os.path.splitext(docx_path)[0] + ".pdf"
+    args = ["libreoffice"]
+    if profile is not None:
+        args.append("-env:UserInstallation=" + pathlib.Path(profile).as_uri())
+    result = _run_converter(
+        args + [
+            "--headless",
+            "--convert-to", "pdf",
+            "--outdir", out_dir,
+            docx_path
+        ],
+        # Without this a LibreOffice that hangs holds the worker
+        # until Render kills the whole instance. Two minutes is
+        # well past any real conversion, and it never gets more
+        # than the deadline leaves, less a moment to send the DOCX
+        # if it fails.
+        timeout=min(120, deadline - time.monotonic() - 5),
+        still_wanted=still_wanted,
+    )
+
+    print("[📄] LibreOffice stdout:\n", result.stdout, flush=True)
+    print("[⚠️] LibreOffice stderr:\n", result.stderr, flush=True)
+
+    if result.returncode != 0:
+        raise RuntimeError(f"LibreOffice conversion failed: {result.stderr}")
+
+    if not os.path.exists(pdf_path):
+        raise FileNotFoundError(f"Expected PDF not found at {pdf_path}")
+    return pdf_path
+
+
+def _convert(docx_path, deadline, cancelled):
+    """Turn the DOCX into a PDF. Runs on a converter thread, so it has no
+    request to look at: `deadline` and `cancelled` are all it knows."""
+    if cancelled.is_set():
+        return None
+    temp_dir = os.path.dirname(docx_path)
+
+    parts = None
+    if PDF_SPLIT > 1 and sections.available():
+        try:
+            parts = sections.split_docx(
+                docx_path, PDF_SPLIT,
+                lambda n: os.path.join(temp_dir, f"part-{n + 1}.docx"),
+            )
+        except Exception as e:
+            print(f"[⚠️] Could not cut the report into parts: {e}", flush=True)
+
+    if parts:
+        pdf_path = _convert_parts(parts, deadline, cancelled)
+    else:
+        profile = _borrow_profile()
+        try:
+            pdf_path = _libreoffice(
+                docx_path, deadline, lambda: not cancelled.is_set(), profile
+            )
+        finally:
+            _return_profile(profile)
+
+    with open(pdf_path, "rb") as f:
+        pdf_bytes = f.read()
+
+    print(f"[✅] PDF generated: {pdf_path}", flush=True)
+    return pdf_bytes
+
+
+class _PartFailed(Exception):
+    """Another part of the same report failed to convert, so this one was
+    stopped: the report goes out as its DOCX whatever this part does."""
+
+
+def _convert_parts(parts, deadline, cancelled):
+    """Convert the parts of a cut report at once and join their PDFs. One part
+    failing stops the rest: the report falls back to its DOCX either way."""
+    started = time.monotonic()
+    failed = threading.Event()
+
+    def still_wanted():
+        if failed.is_set():
+            raise _PartFailed("another part failed")
+        return not cancelled.is_set()
+
+    def convert(part):
+        profile = _borrow_profile()
+        try:
+            return _libreoffice(part, deadline, still_wanted, profile)
+        except Exception:
+            failed.set()
+            raise
+        finally:
+            _return_profile(profile)
+
+    with ThreadPoolExecutor(max_workers=len(parts), thread_name_prefix='part') as pool:
+        futures = [pool.submit(convert, part) for part in parts]
+    # What goes up is why the first part failed, not that the others were
+    # stopped for it -- whichever of them comes first in the report.
+    errors = [future.exception() for future in futures]
+    for error in errors:
+        if error is not None and not isinstance(error, _PartFailed):
+            raise error
+    pdfs = [future.result() for future in futures]
+
+    pdf_path = os.path.join(os.path.dirname(parts[0]), "report.pdf")
+    sections.merge_pdfs(pdfs, pdf_path)
+    print(
+        f"[📄] Converted in {len(parts)} parts in {time.monotonic() - started:.1f}s",
+        flush=True,
+    )
+    metrics.observe('convert_parts', len(parts))
+    return pdf_path
+
+
+def _convert_to_pdf(docx_path):
+    """The PDF of this report, or None if the DOCX is to go instead.
+
+    The conversion itself runs in the converter lane; this thread waits for it,
+    watching the client and the deadline. A conversion that has not started by
+    the time there is no longer room for one is taken back out of the queue.
+    """
+    # A PDF there is no longer time for is not attempted. Starting it
+    # anyway would spend what is left and then fall back to the DOCX
+    # regardless, or run past gunicorn's timeout and lose the DOCX as well.
+    if _remaining() < PDF_BUDGET:
+        _degrade('pdf-skipped')
+        return None
+    if _converter.waiting >= CONVERT_QUEUE:
+        _degrade('pdf-busy')
+        return None
+
+    cancelled = threading.Event()
+    future, waited = _converter.submit(_convert, docx_path, g._deadline, cancelled)
+    while True:
+        try:
+            pdf_bytes = future.result(timeout=0.5)
+            break
+        except FutureTimeout:
+            if not _client_connected():
+                cancelled.set()
+                future.cancel()
+                raise _ClientGone("waiting for PDF conversion")
+            if _remaining() < PDF_BUDGET and future.cancel():
+                _degrade('pdf-skipped')
+                return None
+        except Exception as e:
+            print(f"[❌] PDF generation failed: {e}. Falling back to DOCX.", flush=True)
+            _degrade('pdf-failed')
+            return None
+        finally:
+            if waited:
+                metrics.observe('convert_wait_seconds', waited.pop())
+    return pdf_bytes
+
+
+# A batch: several surveys in one request, for a surveyor working through a
+# marina or a fleet. Each survey's fields and files are named "<n>.<field>" --
+# "1.vessel_name", "1.vessel_photo", "2.vessel_name" -- with "template" and
+# "format" at the top level as the default for any survey that does not name
+# its own. The answer is a ZIP, written as each report finishes.
+BATCH_MAX_SURVEYS = int(os.environ.get('REPORT_BATCH_MAX_SURVEYS') or 40)
+
+# Reports from one batch built at once. They go through the same scheduler as
+# everyone else's, as the one client, with this as that client's share instead
+# of REPORT_CLIENT_CONCURRENCY -- a batch still gets no more of the render slots
+# than it would by sending this many single reports.
+BATCH_CONCURRENCY = int(os.environ.get('REPORT_BATCH_CONCURRENCY') or 2)
+
+# A batch is allowed a bigger body than a single report. Werkzeug spools any
+# upload over half a megabyte to disk while it reads, so this is disk, not
+# memory.
+BATCH_MAX_MB = int(os.environ.get('REPORT_BATCH_MAX_MB') or 256)
+
+BATCH_FIELD = re.compile(r"^(\d+)\.(.+)$")
+
+
+class _Request(Request):
+    """Flask's request, with a batch's bigger limits on /generate_batch."""
+
+    @property
+    def max_content_length(self):
+        if self.path == '/generate_batch':
+            return BATCH_MAX_MB * 1024 * 1024
+        return super().max_content_length
+
+    @property
+    def max_form_parts(self):
+        # Werkzeug stops at a thousand parts, which is one heavy survey's
+        # photographs and fields a dozen times over, not a fleet's.
+        if self.path == '/generate_batch':
+            return 1000 * BATCH_MAX_SURVEYS
+        return 1000
+
+
+app.request_class = _Request
+
+
+class _PhotoCache:
+    """Prepared photographs, shared by every survey in one batch.
+
+    A batch repeats itself: the surveyor's signature is on every report, and a
+    marina's boats are often photographed against the same pontoon shots. Each
+    photograph is known by its bytes and the width it was prepared at, and
+    prepared once. What is kept here lives in the batch's own directory, since
+    each survey's temporary files go as soon as that survey is done.
+
+    Two surveys building at once often reach the same photograph together. The
+    first prepares it; the second waits for that rather than preparing it too.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._ready = {}
+
+    def prepared(self, path, width):
+        digest = _file_digest(path)
+        key = f"{digest}-{width}"
+        while True:
+            with self._lock:
+                ready = self._ready.get(key)
+                if ready is None:
+                    ready = self._ready[key] = Future()
+                    break
+            metrics.count('batch_photo_cache_hits')
+            try:
+                return ready.result()
+            except Exception:
+                # Whoever was preparing it failed, and took it back out. Try
+                # it here instead.
+                continue
+
+        metrics.count('batch_photo_cache_misses')
+        try:
+            prepared = _prepare_shared(path, width, digest)
+            kept = os.path.join(self.directory, key + os.path.splitext(prepared)[1])
+            shutil.copyfile(prepared, kept)
+        except BaseException as e:
+            with self._lock:
+                del self._ready[key]
+            ready.set_exception(e)
+            raise
+        ready.set_result(kept)
+        return kept
+
+
+class _ZipSink(io.RawIOBase):
+    """Where the batch's ZipFile writes, emptied after each report.
+
+    It cannot seek, so zipfile writes each entry's sizes after its data rather
+    than going back for them, and nothing has to be held once it is sent.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _batch_surveys(form, files):
+    """{n: (form, files)} for each survey in a batch, in number order."""
+    surveys = {}
+    for source, target in ((form.items(multi=False), 0), (files.items(multi=False), 1)):
+        for key, value in source:
+            match = BATCH_FIELD.match(key)
+            if match:
+                n = int(match.group(1))
+                surveys.setdefault(n, ({}, {}))[target][match.group(2)] = value
+    for survey_form, _ in surveys.values():
+        survey_form.setdefault('template', form.get('template', 'survey_template_01a.docx'))
+        survey_form.setdefault('format', form.get('format', 'docx'))
+        if form.get('max_report_bytes'):
+            survey_form.setdefault('max_report_bytes', form['max_report_bytes'])
+    return dict(sorted(surveys.items()))
+
+
+@app.route('/generate_batch', methods=['POST'])
+def generate_batch():
+    refusal = _key_refusal()
+    if refusal is not None:
+        return refusal
+
+    surveys = _batch_surveys(request.form, request.files)
+    if not surveys:
+        return {"error": "That batch has no surveys in it."}, 400
+    if len(surveys) > BATCH_MAX_SURVEYS:
+        print(f"[📦] Refused a batch of {len(surveys)} surveys", flush=True)
+        return {"error": f"A batch can hold at most {BATCH_MAX_SURVEYS} surveys."}, 400
+
+    templates = {}
+    for n, (form, _files) in surveys.items():
+        name = form['template']
+        if name not in templates:
+            templates[name] = _templates.get(name)
+        if templates[name] is None:
+            print(f"[🚫] Refused unknown template in survey {n}: {name!r}", flush=True)
+            return {"error": f"Unknown template in survey {n}."}, 400
+        try:
+            _size_budget(form.get('max_report_bytes'))
+        except ValueError:
+            return {"error": f"max_report_bytes in survey {n} must be a whole number of bytes."}, 400
+
+    print(f"[📚] Batch of {len(surveys)} surveys", flush=True)
+    metrics.count('batch_surveys', len(surveys))
+    cache = _PhotoCache(_temp_dir())
+    return Response(
+        stream_with_context(_stream_batch(surveys, templates, cache, _client_id())),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=reports.zip'},
+    )
+
+
+def _stream_batch(surveys, templates, cache, client):
+    """The batch's ZIP, an entry at a time, in the order the reports finish."""
+    sink = _ZipSink()
+    manifest = []
+    environ = request.environ
+    pool = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch')
+    futures = {}
+    try:
+        futures = {
+            pool.submit(_batch_one, environ, form, files, templates[form['template']], cache, client): n
+            for n, (form, files) in surveys.items()
+        }
+        with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as zf:
+            for future in as_completed(futures):
+                n = futures[future]
+                form = surveys[n][0]
+                try:
+                    body, _mimetype, download_name, record = future.result()
+                except (_ClientGone, Abandoned):
+                    # Nobody is reading the rest.
+                    print("[🔌] Batch abandoned by the client", flush=True)
+                    return
+                except Exception as e:
+                    # By its type as well: some say nothing on their own, like
+                    # python-docx's UnrecognizedImageError().
+                    reason = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+                    print(f"[❌] Survey {n} in a batch failed: {reason}", flush=True)
+                    metrics.count('batch_failed')
+                    name = f"{n:02d}-error.txt"
+                    zf.writestr(name, f"Survey {n} could not be built: {reason}\n")
+                    manifest.append({"survey": n, "file": name, "error": reason})
+                else:
+                    vessel = secure_filename(form.get('vessel_name', '')) or 'report'
+                    name = f"{n:02d}-{vessel}{os.path.splitext(download_name)[1]}"
+                    # Stored: a DOCX or a PDF is compressed already.
+                    zf.writestr(name, body)
+                    manifest.append(dict(record, survey=n, file=name, bytes=len(body)))
+                    del body
+                yield sink.take()
+            manifest.sort(key=lambda entry: entry["survey"])
+            zf.writestr("manifest.json", json.dumps({"reports": manifest}, indent=2))
+        yield sink.take()
+    finally:
+        # Those already building notice a client that has gone at their next
+        # checkpoint; the rest never start.
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _batch_one(environ, form, files, template, cache, client):
+    """Build one survey of a batch, on a batch thread.
+
+    Its own request context over the batch's environ, rather than
+    copy_current_request_context: a copied context shares the request object,
+    and popping it closes that request's files under the surveys still reading
+    them. A fresh one also means a fresh g, so the survey has its own deadline,
+    its own temporary files, and gives them back as soon as it is done.
+    """
+    with app.request_context(environ):
+        _start_deadline()
+        g._photo_cache = cache
+        g._size_budget = _size_budget(form.get('max_report_bytes'))
+        started = time.monotonic()
+        g._survey = parse_survey(form, files)
+        g._probes = _probe_photos(g._survey)
+        if SHAPE_LOG:
+            _record_shape(form, files, g._probes)
+        body, mimetype, download_name = _produce(
+            form, files, form['format'].lower(), template, client, limit=BATCH_CONCURRENCY
+        )
+        record = {
+            "seconds": round(time.monotonic() - started, 3),
+            "budget": g._size_budget,
+            "queue_wait": round(g._queue_wait, 3),
+            "degraded": list(g._degraded),
+        }
+        return body, mimetype, download_name, record
+
+
+# A preview: the survey as a web page, built from the same context as the
+# report, for checking the wording while it is still being written. The app
+# refreshes it as the owner types, so it has to come back in well under a
+# second -- no document, no PDF, no queue, and photographs as thumbnails.
+#
+# Pixels per inch for the thumbnails, from the width each photograph has in the
+# report: 4.5" walk-round photographs come out 432 pixels wide.
+PREVIEW_DPI = 96
+
+# Thumbnails kept between previews, by the photograph's bytes. Every refresh
+# sends the same photographs again; only the first pays to shrink them. Each is
+# twenty or thirty kilobytes.
+PREVIEW_CACHE = int(os.environ.get('REPORT_PREVIEW_CACHE') or 256)
+
+_thumbnails = OrderedDict()
+_thumbnails_lock = threading.Lock()
+
+SEVERITY_TITLES = {
+    "aa": "AA Findings",
+    "a": "A Findings",
+    "b": "B Findings",
+    "c": "C Findings",
+    "monitor": "Monitor Findings",
+    "ftr": "FTR Findings",
+}
+
+# Shown at the top of the preview rather than in the list of everything else.
+PREVIEW_HEADLINE = (
+    "vessel_name", "client_name", "survey_type", "survey_date",
+    "location_of_survey", "survey_overview",
+)
+
+
+def _thumbnail(path, width):
+    """A data: URI for the photograph at `path`, `width` (in Inches) wide."""
+    pixels = int(width.inches * PREVIEW_DPI)
+    key = (_file_digest(path), pixels)
+    with _thumbnails_lock:
+        uri = _thumbnails.get(key)
+        if uri is not None:
+            _thumbnails.move_to_end(key)
+            return uri
+
+    try:
+        with Image.open(path) as img:
+            # The decoder does most of the shrinking as it reads, which is what
+            # makes this quick: a phone photograph is read at an eighth.
+            img.draft('RGB', (pixels, pixels))
+            small = ImageOps.exif_transpose(img)
+            small.thumbnail((pixels, pixels * 2))
+            if small.mode not in ("RGB", "L"):
+                small = small.convert("RGB")
+            out = io.BytesIO()
+            small.save(out, format='JPEG', quality=70)
+    except Exception as e:
+        print(f"[⚠️] Thumbnail failed for {path}: {e}", flush=True)
+        return ""
+    uri = "data:image/jpeg;base64," + base64.b64encode(out.getvalue()).decode('ascii')
+
+    with _thumbnails_lock:
+        _thumbnails[key] = uri
+        while len(_thumbnails) > PREVIEW_CACHE:
+            _thumbnails.popitem(last=False)
+    return uri
+
+
+def _label(key):
+    return key.replace('_', ' ').capitalize()
+
+
+@app.route('/preview', methods=['POST'])
+def preview():
+    refusal = _key_refusal()
+    if refusal is not None:
+        return refusal
+
+    started = time.monotonic()
+    form = request.form.to_dict()
+    files = request.files
+    survey = parse_survey(form, files)
+    # Thumbnails are made from the full photograph, so one too large to open
+    # is as much a danger here.
+    _probe_photos(survey)
+    context = _survey_context(survey, lambda _field, path, width: _thumbnail(path, width))
+
+    # Everything the owner wrote that is not in the headline or the findings,
+    # in the order the app sent it, with its date alongside where it has one.
+    fields = [
+        (_label(item.name), item.value, item.date or "")
+        for item in survey.items.values()
+        if item.name not in PREVIEW_HEADLINE and not item.name.endswith('_date')
+        and str(item.value).strip()
+    ]
+
+    page = render_template(
+        'preview.html',
+        survey=context,
+        photos=[
+            (_label(photo.base), context[photo.field])
+            for photo in survey.photos
+            if context.get(photo.field)
+        ],
+        findings=[
+            (SEVERITY_TITLES[sev], context[f"{sev}_findings_items"])
+            for sev in SEVERITIES
+            if context[f"{sev}_findings_items"]
+        ],
+        fields=fields,
+    )
+    metrics.observe('preview_seconds', time.monotonic() - started)
+    return page
+
+
 @app.route('/health')
 def health():
     return {"status": "ok"}
@@ -0,0 +1,158 @@
+"""Request bodies sent compressed, with Content-Encoding: gzip or zstd.
+
+A report is mostly photographs, which are compressed already, but not all of
+it: the long free-text fields squeeze to a fraction of their size, and a
+photograph sent as `_base64` is a third bigger than its bytes until it is. On a
+phone over marina wifi that is time the surveyor spends watching a spinner.
+
+The body is decompressed as it is read, never whole. What it decompresses to is
+what counts against MAX_CONTENT_LENGTH -- the request's Content-Length is
+dropped and Werkzeug limits the stream instead -- so a small body that inflates
+to gigabytes is refused at the limit like any other large report, rather than
+being decompressed into memory first.
+
+zstd needs the zstandard package; without it a zstd body is refused with a 415
+and the app can send gzip instead.
+"""
+
+import io
+import json
+import zlib
+
+from werkzeug.exceptions import BadRequest
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Read from the network this much at a time.
+CHUNK = 64 * 1024
+
+
+class BadBody(BadRequest):
+    """A body that said it was compressed and was not, or not properly."""
+
+
+class _Counted:
+    """A request body, counting what is read from it."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.bytes += len(data)
+        return data
+
+    def readinto(self, buffer):
+        n = self._stream.readinto(buffer)
+        self.bytes += n or 0
+        return n
+
+
+class _GzipReader(io.RawIOBase):
+    """gzip decompressed a buffer at a time. A read never asks zlib for more
+    than it has room for, so no one read can inflate past the buffer."""
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            if not self._pending:
+                self._pending = self._raw.read(CHUNK)
+                if not self._pending:
+                    if not self._zlib.eof:
+                        raise BadBody("The compressed body ended early.")
+                    return 0
+            if self._zlib.eof:
+                # Another gzip member follows; gzip allows them end to end.
+                self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                data = self._zlib.decompress(self._pending, len(buffer))
+            except zlib.error as e:
+                raise BadBody(f"The body is not valid gzip: {e}") from e
+            if self._zlib.eof:
+                self._pending = self._zlib.unused_data
+            else:
+                self._pending = self._zlib.unconsumed_tail
+            if data:
+                buffer[:len(data)] = data
+                return len(data)
+
+
+class _ZstdReader(io.RawIOBase):
+    def __init__(self, raw):
+        self._reader = zstandard.ZstdDecompressor().stream_reader(
+            raw, read_size=CHUNK, read_across_frames=True
+        )
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            data = self._reader.read(len(buffer))
+        except zstandard.ZstdError as e:
+            raise BadBody(f"The body is not valid zstd: {e}") from e
+        buffer[:len(data)] = data
+        return len(data)
+
+
+READERS = {"gzip": _GzipReader, "x-gzip": _GzipReader}
+if zstandard is not None:
+    READERS["zstd"] = _ZstdReader
+
+
+class DecompressingMiddleware:
+    """Wraps the WSGI app so compressed request bodies reach it plain.
+
+    `metrics` is told, per request, how many bytes came over the wire and how
+    many they made, and the ratio between them.
+    """
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+        if not encoding or encoding == "identity":
+            return self.app(environ, start_response)
+
+        reader = READERS.get(encoding)
+        if reader is None:
+            print(f"[📦] Refused a body sent as {encoding!r}", flush=True)
+            body = json.dumps(
+                {"error": f"Bodies sent as {encoding} are not accepted. Send gzip."}
+            ).encode()
+            start_response("415 Unsupported Media Type", [
+                ("Content-Type", "application/json"),
+                ("Content-Length", str(len(body))),
+            ])
+            return [body]
+
+        counted = _Counted(environ["wsgi.input"])
+        plain = _Counted(io.BufferedReader(reader(counted), CHUNK))
+        environ["wsgi.input"] = plain
+        environ["wsgi.input_terminated"] = True
+        environ.pop("CONTENT_LENGTH", None)
+        del environ["HTTP_CONTENT_ENCODING"]
+
+        try:
+            return self.app(environ, start_response)
+        finally:
+            # By now the form has been parsed, even for a batch whose answer is
+            # still to stream, so the body has been read as far as it ever will.
+            self.metrics.count(f"request_bodies_{encoding.replace('x-', '')}")
+            self.metrics.count("request_bytes_compressed", counted.bytes)
+            self.metrics.count("request_bytes_decompressed", plain.bytes)
+            if counted.bytes:
+                self.metrics.observe("request_compression_ratio", plain.bytes / counted.bytes)
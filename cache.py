@@ -0,0 +1,268 @@
+"""A cache the server's instances can share, for work worth not doing twice.
+
+Each Render instance has its own disk and its own memory, and is replaced
+whenever Render likes. Anything one instance remembers -- a photograph already
+turned upright and shrunk, a report already built -- is no use to the next
+request if that lands on another instance, or on a fresh one. Pointed at a Redis
+all the instances can reach, they share one cache; pointed at a directory, one
+instance keeps its own across worker restarts.
+
+    REPORT_CACHE_URL=file:///var/cache/reports
+    REPORT_CACHE_URL=redis://:password@cache-host:6379/0
+
+Nothing here is allowed to fail a report. A cache that cannot be reached, or
+answers with nonsense, is a miss, counted as an error in /metrics.
+
+The Redis client speaks just enough of the protocol for GET and SET with an
+expiry, over a plain socket; scripts/cachestandin.py answers the same commands
+for trying it without a Redis.
+"""
+
+import os
+import socket
+import tempfile
+import threading
+import time
+from urllib.parse import unquote, urlparse
+
+
+class CacheError(Exception):
+    """The backend did not answer, or not sensibly."""
+
+
+# After a failure the backend is left alone this many seconds. A cache that
+# has gone away would otherwise cost its timeout on every photograph.
+RETRY_AFTER = 30
+
+
+class Cache:
+    """A backend, with namespaces and counts.
+
+    `namespace` keeps photographs and reports apart in one store and in
+    /metrics. Values over `max_item_bytes` are not stored at all.
+    """
+
+    def __init__(self, backend, metrics, ttl, max_item_bytes):
+        self.backend = backend
+        self.metrics = metrics
+        self.ttl = ttl
+        self.max_item_bytes = max_item_bytes
+        self._down_until = 0.0
+
+    def get(self, namespace, key):
+        if self._resting(namespace):
+            return None
+        try:
+            value = self.backend.get(f"report:{namespace}:{key}")
+        except (CacheError, OSError) as e:
+            self._failed(namespace, "read", e)
+            return None
+        self.metrics.count(f"cache_{namespace}_{'misses' if value is None else 'hits'}")
+        return value
+
+    def set(self, namespace, key, value):
+        if len(value) > self.max_item_bytes:
+            self.metrics.count(f"cache_{namespace}_too_big")
+            return
+        if self._resting(namespace):
+            return
+        try:
+            self.backend.set(f"report:{namespace}:{key}", value, self.ttl)
+        except (CacheError, OSError) as e:
+            self._failed(namespace, "write", e)
+            return
+        self.metrics.count(f"cache_{namespace}_stores")
+        self.metrics.count(f"cache_{namespace}_bytes_stored", len(value))
+
+    def _resting(self, namespace):
+        if time.monotonic() < self._down_until:
+            self.metrics.count(f"cache_{namespace}_skipped")
+            return True
+        return False
+
+    def _failed(self, namespace, what, error):
+        print(f"[🗄️] Cache {what} failed, leaving it for {RETRY_AFTER}s: {error}", flush=True)
+        self.metrics.count(f"cache_{namespace}_errors")
+        self._down_until = time.monotonic() + RETRY_AFTER
+
+
+class DirectoryBackend:
+    """Files in a directory, one per key, kept under `max_bytes` in all.
+
+    A file's modification time is set to when it expires, so finding what has
+    expired, or what expires soonest and goes first when there is no room, is
+    a directory listing. Writes go to a temporary name and are renamed into
+    place, so a worker never reads half of what another is writing.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key.replace("/", "_").replace(":", "-"))
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if os.stat(path).st_mtime < time.time():
+                os.remove(path)
+                return None
+            with open(path, "rb") as handle:
+                return handle.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value, ttl):
+        path = self._path(key)
+        handle, temp = tempfile.mkstemp(dir=self.directory, prefix=".incoming-")
+        try:
+            with os.fdopen(handle, "wb") as out:
+                out.write(value)
+            expires = time.time() + ttl
+            os.utime(temp, (expires, expires))
+            os.replace(temp, path)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        self._make_room()
+
+    def _make_room(self):
+        with self._lock:
+            entries = []
+            total = 0
+            now = time.time()
+            with os.scandir(self.directory) as listing:
+                for entry in listing:
+                    if entry.name.startswith(".incoming-"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            entries.sort()
+            for expires, size, path in entries:
+                if total <= self.max_bytes and expires >= now:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+class RedisBackend:
+    """GET and SET with PX against anything that speaks RESP.
+
+    One connection per thread, made when first needed and made again after any
+    error. Replies that take longer than `timeout` seconds count as errors: a
+    slow cache is worse than none.
+    """
+
+    def __init__(self, host, port, password=None, db=0, timeout=0.5):
+        self.address = (host, port)
+        self.password = password
+        self.db = db
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self, key):
+        return self._command(b"GET", key.encode())
+
+    def set(self, key, value, ttl):
+        reply = self._command(b"SET", key.encode(), value, b"PX", str(int(ttl * 1000)).encode())
+        if reply != b"OK":
+            raise CacheError(f"SET answered {reply!r}")
+
+    def _command(self, *args):
+        connection = getattr(self._local, "connection", None)
+        try:
+            if connection is None:
+                connection = self._connect()
+            return self._call(connection, args)
+        except (CacheError, OSError):
+            self._close()
+            raise
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        connection = (sock, sock.makefile("rb"))
+        self._local.connection = connection
+        if self.password:
+            self._call(connection, (b"AUTH", self.password.encode()))
+        if self.db:
+            self._call(connection, (b"SELECT", str(self.db).encode()))
+        return connection
+
+    def _close(self):
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    def _call(self, connection, args):
+        sock, reader = connection
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            out.append(b"$%d\r\n" % len(arg))
+            out.append(arg)
+            out.append(b"\r\n")
+        sock.sendall(b"".join(out))
+        return self._reply(reader)
+
+    def _reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise CacheError("connection closed mid-reply")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest
+        if kind == b"-":
+            raise CacheError(rest.decode(errors="replace"))
+        if kind == b":":
+            return _integer(rest)
+        if kind == b"$":
+            length = _integer(rest)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            if len(data) != length + 2:
+                raise CacheError("connection closed mid-reply")
+            return data[:-2]
+        raise CacheError(f"unexpected reply {line[:20]!r}")
+
+
+def _integer(text):
+    # A garbled number is as much nonsense as a garbled reply, and leaves the
+    # connection at no telling where.
+    try:
+        return int(text)
+    except ValueError:
+        raise CacheError(f"not a number: {text[:20]!r}")
+
+
+def from_url(url, metrics, ttl, max_bytes, max_item_bytes):
+    """The cache REPORT_CACHE_URL names, or None for none."""
+    if not url:
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme == "file":
+        backend = DirectoryBackend(unquote(parsed.path), max_bytes)
+    elif parsed.scheme == "redis":
+        # How much Redis keeps is Redis's business: maxmemory and an eviction
+        # policy on the server, not a count kept here.
+        backend = RedisBackend(
+            parsed.hostname or "localhost",
+            parsed.port or 6379,
+            password=unquote(parsed.password) if parsed.password else None,
+            db=int(parsed.path.strip("/") or 0),
+        )
+    else:
+        raise ValueError(f"REPORT_CACHE_URL must be file:// or redis://, not {url!r}")
+    return Cache(backend, metrics, ttl, max_item_bytes)
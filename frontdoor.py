@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+"""Take each request in whole before gunicorn sees any of it.
+
+A survey is ten or fifteen megabytes, sent from a phone on a marina's wifi. At
+a hundred kilobytes a second that is two minutes, and under gunicorn alone all
+two minutes are spent in one of its threads, reading the body as it trickles
+in. Four phones on a bad connection held every thread the worker had, and a
+report that had arrived whole -- or a DOCX ready to go -- waited behind uploads
+that had not.
+
+This sits in front. One asyncio loop reads any number of requests at whatever
+pace they come, each into a spool of its own -- memory for the first
+megabyte, a temporary file after that. Only once a request is all there is it
+passed to gunicorn, over a local socket, at the speed of the disk. An answer
+comes back the same way: read from gunicorn as fast as it writes it into a
+spool of its own, and sent on from there as fast as the phone takes it, so a
+slow download does not hold a thread either.
+
+What this holds in memory is bounded. It shares a 512MB instance with the
+gunicorn workers, and a hundred phones on a slow connection each downloading a
+fifteen megabyte report must not be what takes it down. It accepts at most
+REPORT_FRONT_MAX_CONNECTIONS at once, and does not accept another until one of
+those closes: the rest wait in the kernel's accept queue, where nothing they
+send is read into this process. An accepted connection costs the buffers
+asyncio keeps for it, a few hundred kilobytes at the most. Its spools share
+REPORT_FRONT_MEMORY_MB between all of them, a megabyte apiece while there is
+room, and start on disk when there is not -- so a slow phone costs disk, not
+memory, and not a place in the queue any sooner than its socket does.
+
+    python frontdoor.py gunicorn app:app --workers 2 --threads 6 --timeout 180
+
+listens on $PORT and starts gunicorn as given, bound to a socket of its own.
+Leave --bind off; this adds it. When gunicorn stops, so does this.
+
+One request per connection: each answer says Connection: close. Render's proxy
+is the client here, and opens another. A client that hangs up while its report
+is being built has the connection to gunicorn closed behind it, so the app
+stops building it as it did before.
+"""
+
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# Read and write this much at a time.
+CHUNK = 64 * 1024
+
+# The request line and headers, together. Anything longer is not a report.
+HEAD_LIMIT = 64 * 1024
+
+# A body, or an answer, is kept in memory up to this, and on disk past it...
+SPOOL_MEMORY = 1024 * 1024
+
+# ...while all the spools together have no more than this in memory. Past it a
+# spool starts on disk.
+MEMORY = int(os.environ.get('REPORT_FRONT_MEMORY_MB') or 16) * 1024 * 1024
+
+# Connections accepted at once. Past this the next is left in the kernel's
+# accept queue, BACKLOG long, until one closes. Each accepted one costs what its
+# StreamReader buffers -- up to twice HEAD_LIMIT, and one read of a quarter of
+# a megabyte past that -- and SEND_BUFFER: about 0.4MB at the very most, and
+# far less for a phone, which sends and takes slower than this reads and
+# writes.
+MAX_CONNECTIONS = int(os.environ.get('REPORT_FRONT_MAX_CONNECTIONS') or 128)
+BACKLOG = 128
+
+# Refused here, before it is spooled. The app has its own limits, lower for a
+# single report; this only stops the disk being filled by something far past
+# any of them.
+MAX_BODY = int(os.environ.get('REPORT_FRONT_MAX_MB') or 300) * 1024 * 1024
+
+# A client that sends nothing for this long has gone, whatever its socket says.
+# A slow one is fine; a silent one is not.
+IDLE_SECONDS = float(os.environ.get('REPORT_FRONT_IDLE_SECONDS') or 60)
+
+# What asyncio is given to send on at a time. The rest of an answer waits in
+# its spool.
+SEND_BUFFER = CHUNK
+
+# Headers that are about one connection, not the request, and so are not passed
+# on. Content-Length is written afresh from what was spooled.
+HOP_BY_HOP = {
+    b'connection', b'keep-alive', b'proxy-connection', b'transfer-encoding',
+    b'te', b'trailer', b'upgrade', b'expect', b'content-length',
+}
+
+
+class _Refused(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class _Spool(tempfile.SpooledTemporaryFile):
+    """A spool whose memory comes out of what the door has left, and goes back
+    to it when the spool moves to disk or is closed."""
+
+    def __init__(self, door):
+        self._door = door
+        self._granted = min(SPOOL_MEMORY, door.memory_left)
+        door.memory_left -= self._granted
+        # 0 would mean memory without end. 1 is on disk from the first write.
+        super().__init__(max_size=self._granted or 1)
+
+    def rollover(self):
+        super().rollover()
+        self._give_back()
+
+    def close(self):
+        super().close()
+        self._give_back()
+
+    def _give_back(self):
+        self._door.memory_left += self._granted
+        self._granted = 0
+
+
+class FrontDoor:
+    def __init__(self, upstream_path, connections=MAX_CONNECTIONS, memory=MEMORY):
+        self.upstream_path = upstream_path
+        self.memory_left = memory
+        self._connections = asyncio.Semaphore(connections)
+        self._open = set()
+
+    async def accept(self, listener):
+        """Accept connections on `listener` for as long as this runs, no more
+        than `connections` at once. A connection past that is not accepted --
+        not read, not buffered -- until one closes."""
+        loop = asyncio.get_running_loop()
+        while True:
+            if self._connections.locked():
+                print(f"[🚪] {len(self._open)} connections open; the next waits", flush=True)
+            await self._connections.acquire()
+            try:
+                sock, _ = await loop.sock_accept(listener)
+            except BaseException:
+                self._connections.release()
+                raise
+            task = asyncio.ensure_future(self._serve(sock))
+            self._open.add(task)
+            task.add_done_callback(self._closed)
+
+    def _closed(self, task):
+        self._open.discard(task)
+        self._connections.release()
+
+    async def _serve(self, sock):
+        try:
+            reader, writer = await asyncio.open_connection(sock=sock, limit=HEAD_LIMIT)
+        except OSError:
+            sock.close()
+            return
+        await self.handle(reader, writer)
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        peer = peer[0] if isinstance(peer, tuple) else 'local'
+        spool = None
+        try:
+            try:
+                head = await _idle(reader.readuntil(b"\r\n\r\n"))
+            except asyncio.LimitOverrunError:
+                raise _Refused(431, "Request headers too large.")
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                return
+            method, target, headers = _parse_head(head)
+
+            started = time.monotonic()
+            spool = _Spool(self)
+            if _header(headers, b'expect').lower() == b'100-continue':
+                writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            try:
+                if b'chunked' in _header(headers, b'transfer-encoding').lower():
+                    length = await _read_chunked(reader, spool)
+                else:
+                    length = await _read_length(reader, spool, _content_length(headers))
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                print(f"[🐢] {peer} stopped sending {method.decode()} {target.decode()} "
+                      f"after {time.monotonic() - started:.1f}s", flush=True)
+                return
+            took = time.monotonic() - started
+            if took > 5:
+                print(f"[🐢] {peer} took {took:.1f}s to send {length / 1e6:.1f}MB", flush=True)
+
+            await self._forward(method, target, headers, spool, length, peer, reader, writer)
+        except _Refused as e:
+            _answer(writer, e.status, e.message)
+        except ConnectionError:
+            pass
+        finally:
+            if spool is not None:
+                spool.close()
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+
+    async def _forward(self, method, target, headers, spool, length, peer, reader, writer):
+        try:
+            upstream = await self._connect()
+        except OSError as e:
+            print(f"[🚪] gunicorn is not answering: {e}", flush=True)
+            raise _Refused(502, "The server is starting. Try again shortly.")
+
+        loop = asyncio.get_running_loop()
+        try:
+            out = [method + b" " + target + b" HTTP/1.1\r\n"]
+            forwarded = _header(headers, b'x-forwarded-for')
+            for name, value in headers:
+                if name.lower() in HOP_BY_HOP or name.lower() == b'x-forwarded-for':
+                    continue
+                out.append(name + b": " + value + b"\r\n")
+            # Render's proxy names the phone first; this adds itself after, as
+            # any proxy does, so the app's first hop is still the phone.
+            forwarded = (forwarded + b", " if forwarded else b"") + peer.encode()
+            out.append(b"X-Forwarded-For: " + forwarded + b"\r\n")
+            out.append(b"Content-Length: %d\r\n" % length)
+            out.append(b"Connection: close\r\n\r\n")
+
+            spool.seek(0)
+            try:
+                await loop.sock_sendall(upstream, b"".join(out))
+                for chunk in iter(lambda: spool.read(CHUNK), b""):
+                    await loop.sock_sendall(upstream, chunk)
+            except ConnectionError:
+                # The app answered without reading it all -- a wrong key, a
+                # report too large -- and gunicorn hung up. The answer is
+                # still there to read.
+                pass
+            # Sent; its memory is better spent on the answer.
+            spool.close()
+
+            await self._relay(upstream, reader, writer)
+        finally:
+            upstream.close()
+
+    async def _relay(self, upstream, reader, writer):
+        """gunicorn's answer to the client. Taken from gunicorn as fast as it
+        comes, into a spool, and sent on from the spool at the client's pace,
+        so gunicorn's thread is free once it has written the last of it. Stops
+        early if the client hangs up, which closes the connection gunicorn is
+        watching.
+
+        A plain socket rather than asyncio's streams: gunicorn hangs up on a
+        body it did not read with a reset, and a stream reader raises that
+        ahead of the answer it already holds. The socket gives the answer
+        first.
+        """
+        loop = asyncio.get_running_loop()
+        writer.transport.set_write_buffer_limits(high=SEND_BUFFER)
+        spool = _Spool(self)
+        # Bytes taken from gunicorn, bytes sent on, and whether gunicorn is done.
+        state = {"taken": 0, "sent": 0, "done": False}
+        arrived = asyncio.Event()
+
+        async def take():
+            try:
+                while True:
+                    try:
+                        chunk = await loop.sock_recv(upstream, CHUNK)
+                    except ConnectionResetError:
+                        chunk = b""
+                    if not chunk:
+                        return
+                    spool.seek(state["taken"])
+                    spool.write(chunk)
+                    state["taken"] += len(chunk)
+                    arrived.set()
+            finally:
+                state["done"] = True
+                arrived.set()
+
+        async def give():
+            while True:
+                if state["sent"] < state["taken"]:
+                    spool.seek(state["sent"])
+                    chunk = spool.read(CHUNK)
+                    state["sent"] += len(chunk)
+                    writer.write(chunk)
+                    await writer.drain()
+                elif state["done"]:
+                    return
+                else:
+                    arrived.clear()
+                    await arrived.wait()
+
+        taking = asyncio.ensure_future(take())
+        giving = asyncio.ensure_future(give())
+        hung_up = asyncio.ensure_future(reader.read(CHUNK))
+        try:
+            while True:
+                await asyncio.wait({giving, hung_up}, return_when=asyncio.FIRST_COMPLETED)
+                if giving.done():
+                    giving.result()
+                    if taking.done():
+                        taking.result()
+                    return
+                if not hung_up.exception() and hung_up.result():
+                    # Bytes, not a hang-up: a pipelined request, which gets no
+                    # answer here. Keep watching.
+                    hung_up = asyncio.ensure_future(reader.read(CHUNK))
+                    continue
+                return
+        finally:
+            for task in (taking, giving, hung_up):
+                task.cancel()
+            spool.close()
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        # gunicorn may still be starting.
+        deadline = time.monotonic() + 30
+        while True:
+            upstream = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            upstream.setblocking(False)
+            try:
+                await loop.sock_connect(upstream, self.upstream_path)
+                return upstream
+            except (FileNotFoundError, ConnectionRefusedError):
+                upstream.close()
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+
+def _idle(awaitable):
+    return asyncio.wait_for(awaitable, IDLE_SECONDS)
+
+
+def _parse_head(head):
+    lines = head[:-4].split(b"\r\n")
+    try:
+        method, target, version = lines[0].split(b" ")
+    except ValueError:
+        raise _Refused(400, "Malformed request line.")
+    if not version.startswith(b"HTTP/1."):
+        raise _Refused(505, "HTTP/1.x only.")
+    headers = []
+    for line in lines[1:]:
+        name, sep, value = line.partition(b":")
+        if not sep or not name or name != name.strip():
+            raise _Refused(400, "Malformed header.")
+        headers.append((name, value.strip()))
+    return method, target, headers
+
+
+def _header(headers, name):
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return b""
+
+
+def _content_length(headers):
+    value = _header(headers, b'content-length')
+    if not value:
+        return 0
+    if not value.isdigit():
+        raise _Refused(400, "Malformed Content-Length.")
+    length = int(value)
+    if length > MAX_BODY:
+        raise _Refused(413, "That report is too large to build.")
+    return length
+
+
+async def _read_length(reader, spool, length):
+    left = length
+    while left:
+        data = await _idle(reader.read(min(CHUNK, left)))
+        if not data:
+            raise asyncio.IncompleteReadError(b"", left)
+        spool.write(data)
+        left -= len(data)
+    return length
+
+
+async def _read_chunked(reader, spool):
+    total = 0
+    while True:
+        line = await _idle(reader.readuntil(b"\r\n"))
+        try:
+            size = int(line.split(b";")[0], 16)
+        except ValueError:
+            raise _Refused(400, "Malformed chunked body.")
+        if size == 0:
+            # Trailers, if any, are dropped.
+            while await _idle(reader.readuntil(b"\r\n")) != b"\r\n":
+                pass
+            return total
+        total += size
+        if total > MAX_BODY:
+            raise _Refused(413, "That report is too large to build.")
+        await _read_length(reader, spool, size)
+        await _idle(reader.readexactly(2))
+
+
+REASONS = {
+    400: "Bad Request", 413: "Content Too Large", 431: "Request Header Fields Too Large",
+    502: "Bad Gateway", 505: "HTTP Version Not Supported",
+}
+
+
+def _answer(writer, status, message):
+    print(f"[🚪] Answered {status} at the door: {message}", flush=True)
+    body = json.dumps({"error": message}).encode()
+    writer.write(
+        b"HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n"
+        b"Content-Length: %d\r\nConnection: close\r\n\r\n"
+        % (status, REASONS[status].encode(), len(body)) + body
+    )
+
+
+async def serve(port, upstream_path, upstream):
+    door = FrontDoor(upstream_path)
+    listener = socket.create_server(("0.0.0.0", port), backlog=BACKLOG)
+    listener.setblocking(False)
+    accepting = asyncio.ensure_future(door.accept(listener))
+    print(f"[🚪] Taking requests on :{port} for gunicorn at {upstream_path}", flush=True)
+
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    async def upstream_exited():
+        while upstream.poll() is None:
+            await asyncio.sleep(0.5)
+        stopping.set()
+
+    watcher = asyncio.ensure_future(upstream_exited())
+    try:
+        await stopping.wait()
+    finally:
+        accepting.cancel()
+        listener.close()
+    watcher.cancel()
+    if upstream.poll() is None:
+        upstream.terminate()
+    return upstream.wait()
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    port = int(os.environ.get('PORT') or 10000)
+    upstream_path = os.path.join(tempfile.gettempdir(), f"report-gunicorn-{os.getpid()}.sock")
+    upstream = subprocess.Popen(sys.argv[1:] + ["--bind", f"unix:{upstream_path}"])
+    sys.exit(asyncio.run(serve(port, upstream_path, upstream)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Counts and timings kept in memory, for /metrics.
+
+Nothing is sent anywhere. Each gunicorn worker keeps its own, so with two
+workers /metrics answers for whichever one took the request; read it a few
+times to see both. That is enough to see a queue forming, which is what this is
+for, without a metrics service the free plan does not have.
+"""
+
+import threading
+
+# Most recent observations kept per timing, for the percentiles.
+KEEP = 500
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self._lock:
+            timing = self._timings.setdefault(
+                name, {"count": 0, "sum": 0.0, "max": 0.0, "recent": []}
+            )
+            timing["count"] += 1
+            timing["sum"] += value
+            timing["max"] = max(timing["max"], value)
+            timing["recent"].append(value)
+            if len(timing["recent"]) > KEEP:
+                del timing["recent"][0]
+
+    def snapshot(self):
+        with self._lock:
+            timings = {}
+            for name, timing in self._timings.items():
+                recent = sorted(timing["recent"])
+                timings[name] = {
+                    "count": timing["count"],
+                    "mean": timing["sum"] / timing["count"],
+                    "max": timing["max"],
+                    "p50": _percentile(recent, 50),
+                    "p95": _percentile(recent, 95),
+                    "p99": _percentile(recent, 99),
+                }
+            return {"counters": dict(self._counters), "timings": timings}
+
+
+def _percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
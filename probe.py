@@ -0,0 +1,129 @@
+"""What a photograph will cost, from its header, before it is decoded.
+
+Opening a photograph with Pillow reads its header and stops; the pixels come
+later, when something asks for them. The header says how big the photograph is,
+what it is, and -- in its EXIF -- which way up. That is enough to know most of
+what preparing it will cost, and to refuse the ones that would cost too much
+before anything is spent on them.
+
+A photograph can be a few kilobytes on the wire and gigabytes once decoded: a
+JPEG of one colour at 60000 pixels square compresses to almost nothing. Found
+out in prepare_image, it has already taken the worker down. Found out here, it
+is a 413 naming the field.
+
+The costs are estimates, measured on this server's own prepare_image:
+
+  - memory: the largest bitmap prepare_image holds at once. Lean rendering has
+    the JPEG decoder scale by a half, a quarter or an eighth while it reads,
+    so a large JPEG costs what its scaled size does. Nothing else scales.
+  - time: a fixed part for resizing and saving, a part for each megapixel
+    decoded, and for JPEG a small part for each megapixel in the file, which
+    the decoder reads whether it scales or not.
+"""
+
+from PIL import Image
+
+# Seconds, from timing prepare_image on bench.py's photographs at sizes from
+# one to forty-eight megapixels.
+FIXED_SECONDS = 0.04
+SECONDS_PER_DECODED_MP = 0.015
+SECONDS_PER_PNG_MP = 0.03
+SECONDS_PER_JPEG_FILE_MP = 0.0025
+
+
+class TooManyPixels(Exception):
+    """A photograph that would take more memory to decode than is allowed."""
+
+    def __init__(self, field, width=None, height=None, needs=None):
+        self.field = field
+        self.width = width
+        self.height = height
+        self.needs = needs
+        if width:
+            super().__init__(f"{field} is {width}x{height} pixels")
+        else:
+            super().__init__(f"{field} has more pixels than Pillow will open")
+
+
+class Probe:
+    """A photograph's header: its size, format, band layout and EXIF
+    orientation."""
+
+    __slots__ = ("width", "height", "format", "mode", "orientation")
+
+    def __init__(self, width, height, format, mode, orientation):
+        self.width = width
+        self.height = height
+        self.format = format
+        self.mode = mode
+        self.orientation = orientation
+
+    @property
+    def upright(self):
+        return self.orientation in (1, None)
+
+    def needs_nothing(self, max_width, word_formats):
+        """Whether prepare_image would hand this one back as it is."""
+        return self.upright and self.width <= max_width and self.format in word_formats
+
+    def _bands(self):
+        try:
+            return Image.getmodebands(self.mode)
+        except (KeyError, ValueError):
+            return 4
+
+    def _draft_scale(self, max_width, draft):
+        """What the JPEG decoder will divide both sides by, as Image.draft
+        chooses it for a square box `max_width` on a side."""
+        if not draft or self.format != "JPEG":
+            return 1
+        most = min(self.width // max_width, self.height // max_width)
+        for scale in (8, 4, 2):
+            if scale <= most:
+                return scale
+        return 1
+
+    def decode_bytes(self, max_width, draft):
+        """The most memory preparing this photograph holds at once."""
+        scale = self._draft_scale(max_width, draft)
+        width, height = -(-self.width // scale), -(-self.height // scale)
+        bands = 3 if self.format == "JPEG" and self.mode != "L" else self._bands()
+        decoded = width * height * bands
+        if not self.upright:
+            # The decoded bitmap and the turned copy, side by side.
+            decoded *= 2
+        if width > max_width:
+            decoded += max_width * (height * max_width // width) * bands
+        return decoded
+
+    def seconds(self, max_width, draft, word_formats):
+        """Roughly how long prepare_image takes over it."""
+        if self.needs_nothing(max_width, word_formats):
+            return 0.0
+        scale = self._draft_scale(max_width, draft)
+        decoded_mp = self.width * self.height / scale / scale / 1e6
+        per_mp = SECONDS_PER_PNG_MP if self.format == "PNG" else SECONDS_PER_DECODED_MP
+        seconds = FIXED_SECONDS + decoded_mp * per_mp
+        if self.format == "JPEG":
+            seconds += self.width * self.height / 1e6 * SECONDS_PER_JPEG_FILE_MP
+        return seconds
+
+
+def probe(stream, field):
+    """The Probe for the photograph in `stream`, which is left where it was,
+    or None if the header cannot be read -- the photograph is then prepared as
+    it always was, and fails there if it is going to.
+
+    Raises TooManyPixels for one so large Pillow itself will not open it.
+    """
+    here = stream.tell()
+    try:
+        with Image.open(stream) as img:
+            orientation = (img.getexif() or {}).get(274, 1)
+            return Probe(img.width, img.height, img.format, img.mode, orientation)
+    except Image.DecompressionBombError:
+        raise TooManyPixels(field)
+    except Exception:
+        return None
+    finally:
+        stream.seek(here)
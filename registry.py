@@ -0,0 +1,168 @@
+"""The templates a report can be built from, and new exports of them taken in
+while the server runs.
+
+The two templates used to be files baked into the image, named in a tuple in
+app.py. A fixed export of the owner template -- a typo in the disclaimer, a
+missing placeholder -- meant a deploy, and a deploy is a cold start on every
+instance. Now a template dropped into REPORT_TEMPLATE_DIR is picked up within
+a poll, under its file name: one named like a built-in template replaces it,
+any other is a new template.
+
+What comes in is checked before anything is built from it. It has to be a
+template the scripts would have passed -- scripts/check_template.py's rules,
+the ones the 10 August export failed -- and then it is loaded and compiled, off
+the request path, so a file with a broken tag in it is refused here rather than
+by the first report to use it. A replacement has to pass every rule the version
+it replaces passed; a new template, every rule. Until something passes, the
+version before it goes on serving.
+
+Swapping one in is replacing one dictionary with another. A report that started
+on the old version holds it until it is done; the next report gets the new one.
+
+The names are still a whitelist. `template` on the form is only ever looked up
+here by name, and the only names here are files a person put in one of two
+directories.
+"""
+
+import os
+import re
+import threading
+import time
+
+# A name a template may have: a plain file name, nothing that walks a path.
+NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*\.docx$")
+
+
+class TemplateRegistry:
+    """The templates by name, each a loaded, compiled snapshot of its file.
+
+    `builtin` is {name: path} for the templates in the image. `load(path)`
+    reads and compiles one, raising if it cannot be. `check(path)` is the list
+    of what is wrong with it, empty when nothing is. `directory`, if given, is
+    looked at every `interval` seconds for new or changed templates.
+    """
+
+    def __init__(self, builtin, load, check, directory=None, interval=30):
+        self.builtin = dict(builtin)
+        self.directory = directory
+        self.interval = interval
+        self._load = load
+        self._check = check
+        self._lock = threading.Lock()
+        # name -> (snapshot, where it came from, when it was taken in, what
+        # was wrong with it). Replaced whole, never changed in place.
+        self._current = {}
+        self._rejected = {}
+        self._seen = {}
+        for name, path in self.builtin.items():
+            self._current[name] = (load(path), "built-in", time.time(), frozenset(check(path)))
+
+    def get(self, name):
+        """The snapshot to build a report from, or None for a name that is not
+        a template here."""
+        entry = self._current.get(name)
+        return entry[0] if entry is not None else None
+
+    def __contains__(self, name):
+        return name in self._current
+
+    def start(self):
+        """Watch the directory from a thread of its own, starting now."""
+        if not self.directory:
+            return
+        thread = threading.Thread(target=self._watch, name="templates", daemon=True)
+        thread.start()
+
+    def _watch(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"[📄] Looking for new templates failed: {e}", flush=True)
+            time.sleep(self.interval)
+
+    def poll(self):
+        """Take in whatever has changed in the directory since last time."""
+        try:
+            listing = {
+                entry.name: entry.stat()
+                for entry in os.scandir(self.directory)
+                if entry.is_file() and NAME.match(entry.name)
+            }
+        except FileNotFoundError:
+            listing = {}
+
+        for name, stat in listing.items():
+            version = (stat.st_mtime_ns, stat.st_size)
+            if self._seen.get(name) != version:
+                self._seen[name] = version
+                self._consider(name, os.path.join(self.directory, name))
+
+        for name in set(self._seen) - set(listing):
+            del self._seen[name]
+            self._withdraw(name)
+
+    def _consider(self, name, path):
+        entry = self._current.get(name)
+        problems = self._check(path)
+        # What the version serving now passes, this one has to pass too. A new
+        # template has to pass everything.
+        allowed = entry[3] if entry is not None else frozenset()
+        worse = [problem for problem in problems if problem not in allowed]
+        if worse:
+            self._reject(name, worse)
+            return
+        try:
+            snapshot = self._load(path)
+        except Exception as e:
+            self._reject(name, [f"it could not be loaded: {e}"])
+            return
+        with self._lock:
+            current = dict(self._current)
+            current[name] = (snapshot, path, time.time(), frozenset(problems))
+            self._current = current
+            self._rejected.pop(name, None)
+        print(f"[📄] Template {name} {'replaced' if entry else 'added'} from {path}", flush=True)
+
+    def _reject(self, name, problems):
+        print(f"[📄] Refused template {name}:", flush=True)
+        for problem in problems:
+            print(f"       - {problem}", flush=True)
+        with self._lock:
+            self._rejected[name] = {"problems": problems, "at": time.time()}
+
+    def _withdraw(self, name):
+        """A template taken out of the directory: back to the built-in one of
+        that name, or gone."""
+        with self._lock:
+            self._rejected.pop(name, None)
+            current = dict(self._current)
+            if current.get(name, (None, "built-in"))[1] == "built-in":
+                return
+            if name in self.builtin:
+                path = self.builtin[name]
+                current[name] = (
+                    self._load(path), "built-in", time.time(), frozenset(self._check(path))
+                )
+            else:
+                del current[name]
+            self._current = current
+        print(f"[📄] Template {name} withdrawn", flush=True)
+
+    def snapshot(self):
+        """Which version of each template is serving, and what was refused, for
+        /metrics."""
+        current = self._current
+        with self._lock:
+            rejected = dict(self._rejected)
+        return {
+            "serving": {
+                name: {
+                    "source": source,
+                    "digest": snapshot.digest[:12],
+                    "since": round(since),
+                }
+                for name, (snapshot, source, since, _problems) in sorted(current.items())
+            },
+            "refused": rejected,
+        }
@@ -0,0 +1,276 @@
+"""Who builds a report next, when more are waiting than can be built at once.
+
+Before this, the order was whoever's request a gunicorn thread picked up first.
+One surveyor sending a fleet's worth of PDF surveys filled every thread, and an
+owner's one-page DOCX waited behind all of them. Now every client has its own
+queue, and free slots go round the clients in turn rather than down one long
+line -- so a client with twenty reports waiting gets one built, then the next
+client gets one, and so on.
+
+A client is whatever the app names in X-Report-Client. The key in X-Report-Key
+is shared by every copy of the app, so it cannot tell one surveyor from another.
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class QueueFull(Exception):
+    """This client already has as many reports waiting as it is allowed."""
+
+
+class QueueTimeout(Exception):
+    """A report waited for a slot until there was no time left to build it."""
+
+
+class Abandoned(Exception):
+    """Whoever was waiting for a slot stopped waiting."""
+
+
+class _Ticket:
+    __slots__ = ("client", "granted", "limit", "cost")
+
+    def __init__(self, client, limit, cost=0):
+        self.client = client
+        self.granted = False
+        self.limit = limit
+        self.cost = cost
+
+
+class FairScheduler:
+    """Slots for building reports, handed out round-robin between clients.
+
+    `slots` is how many reports are built at once in this process. No client
+    holds more than `per_client` of them, or has more than `queue_length`
+    waiting; one more than that is refused outright rather than queued, since
+    by the time it came up the app would have given up on it.
+
+    `weights` gives some clients more than one turn in a row -- a surveyor on a
+    fleet contract may be worth two turns to every owner's one. Anyone not named
+    has a weight of one.
+
+    `memory`, if given, is how many bytes the reports being built at once may
+    be estimated to need between them. A report whose estimate does not fit
+    waits for some to finish, and keeps its turn while it does: the reports
+    behind it wait too, rather than going round it, or a large survey would
+    wait for ever behind a stream of small ones. One report always runs,
+    however large its estimate.
+    """
+
+    def __init__(self, slots, per_client, queue_length, weights=None, memory=0):
+        self.slots = slots
+        self.per_client = per_client
+        self.queue_length = queue_length
+        self.weights = dict(weights or {})
+        self.memory = memory
+        self._cost = 0
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._active = {}
+        self._running = 0
+        # Clients in the order they first turned up, the one whose turn it is,
+        # and how many more slots that turn is worth.
+        self._ring = []
+        self._turn = None
+        self._credit = 0
+
+    @contextmanager
+    def slot(self, client, timeout=None, still_wanted=None, limit=None, cost=0):
+        """Wait for a slot for `client`, hold it for the block, then free it.
+
+        Yields the seconds spent waiting. `still_wanted` is asked every second
+        while waiting; once it says no, the wait ends with Abandoned, so a
+        client that has hung up stops holding a place in the queue. `limit`
+        stands in for `per_client` for this one -- a batch, which has already
+        been given its own number of threads, asks for that many. `cost` is
+        the report's memory estimate in bytes, counted against `memory`.
+        """
+        waited = self._acquire(client, timeout, still_wanted, limit, cost)
+        try:
+            yield waited
+        finally:
+            self._release(client, cost)
+
+    def _acquire(self, client, timeout, still_wanted, limit=None, cost=0):
+        started = time.monotonic()
+        with self._cond:
+            queue = self._queues.setdefault(client, deque())
+            if len(queue) >= self.queue_length:
+                raise QueueFull(client)
+            if client not in self._ring:
+                self._ring.append(client)
+            ticket = _Ticket(client, limit, cost)
+            queue.append(ticket)
+            self._dispatch()
+
+            while not ticket.granted:
+                left = None if timeout is None else timeout - (time.monotonic() - started)
+                if left is not None and left <= 0:
+                    self._withdraw(ticket)
+                    raise QueueTimeout(client)
+                self._cond.wait(1.0 if left is None else min(left, 1.0))
+                if not ticket.granted and still_wanted is not None and not still_wanted():
+                    self._withdraw(ticket)
+                    raise Abandoned(client)
+        return time.monotonic() - started
+
+    def _release(self, client, cost=0):
+        with self._cond:
+            self._active[client] -= 1
+            self._running -= 1
+            self._cost -= cost
+            self._forget_if_idle(client)
+            self._dispatch()
+
+    def _withdraw(self, ticket):
+        self._queues[ticket.client].remove(ticket)
+        self._forget_if_idle(ticket.client)
+        # It may have been what the ones behind it were waiting on.
+        self._dispatch()
+
+    def _forget_if_idle(self, client):
+        """Drop a client with nothing queued and nothing running, so the ring
+        does not grow by one for every phone that has ever asked."""
+        if not self._queues.get(client) and not self._active.get(client):
+            self._queues.pop(client, None)
+            self._active.pop(client, None)
+            if client in self._ring:
+                at = self._ring.index(client)
+                self._ring.pop(at)
+                if self._turn == client:
+                    # The turn passes to whoever was after it.
+                    self._turn = self._ring[at - 1] if self._ring else None
+                    self._credit = 0
+
+    def _eligible(self, client):
+        queue = self._queues.get(client)
+        if not queue:
+            return False
+        return self._active.get(client, 0) < (queue[0].limit or self.per_client)
+
+    def _next_client(self):
+        if self._turn is not None and self._credit > 0 and self._eligible(self._turn):
+            return self._turn
+        if not self._ring:
+            return None
+        start = self._ring.index(self._turn) + 1 if self._turn in self._ring else 0
+        for i in range(len(self._ring)):
+            client = self._ring[(start + i) % len(self._ring)]
+            if self._eligible(client):
+                self._turn = client
+                self._credit = max(1, self.weights.get(client, 1))
+                return client
+        return None
+
+    def _dispatch(self):
+        """Hand out free slots. Called with the lock held."""
+        granted = False
+        while self._running < self.slots:
+            client = self._next_client()
+            if client is None:
+                break
+            ticket = self._queues[client][0]
+            if self.memory and self._running and self._cost + ticket.cost > self.memory:
+                break
+            self._queues[client].popleft()
+            ticket.granted = True
+            self._active[client] = self._active.get(client, 0) + 1
+            self._running += 1
+            self._cost += ticket.cost
+            self._credit -= 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def snapshot(self):
+        """Queue lengths and slots in use, for /metrics."""
+        with self._cond:
+            return {
+                "slots": self.slots,
+                "running": self._running,
+                "waiting": sum(len(q) for q in self._queues.values()),
+                "memory_mb": self.memory // (1024 * 1024),
+                "estimated_mb_in_use": self._cost // (1024 * 1024),
+                "clients": {
+                    client: {
+                        "waiting": len(self._queues.get(client, ())),
+                        "running": self._active.get(client, 0),
+                    }
+                    for client in self._ring
+                },
+            }
+
+
+class Lane:
+    """A fixed number of threads for one kind of slow work, with its queue on
+    show.
+
+    PDF conversion runs here rather than in the request's own thread holding a
+    render slot. A LibreOffice run takes ten or twenty times as long as the
+    render before it, and while it held a slot, a DOCX that needed a second of
+    work waited behind it.
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._running = 0
+
+    def submit(self, fn, *args):
+        """Queue `fn(*args)`. Returns (future, seconds it waited to start),
+        the second as a one-item list filled in when it starts."""
+        with self._lock:
+            self._waiting += 1
+        queued = time.monotonic()
+        waited = []
+
+        def run():
+            with self._lock:
+                self._waiting -= 1
+                self._running += 1
+            waited.append(time.monotonic() - queued)
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+        future = self._pool.submit(run)
+        future.add_done_callback(self._forget_if_cancelled)
+        return future, waited
+
+    def _forget_if_cancelled(self, future):
+        # A job cancelled before it started never ran, so never stopped
+        # waiting either.
+        if future.cancelled():
+            with self._lock:
+                self._waiting -= 1
+
+    @property
+    def waiting(self):
+        with self._lock:
+            return self._waiting
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "running": self._running,
+                "waiting": self._waiting,
+            }
+
+
+def parse_weights(text):
+    """"fleet-co=3,marina=2" -> {"fleet-co": 3, "marina": 2}."""
+    weights = {}
+    for item in (text or "").split(","):
+        name, _, weight = item.strip().partition("=")
+        if name and weight.strip().isdigit():
+            weights[name] = int(weight)
+    return weights
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+"""Time a report and measure how much memory it takes, on surveys we make up.
+
+    python3 scripts/bench.py
+    python3 scripts/bench.py --payload heavy --repeat 3
+    python3 scripts/bench.py --save --payload heavy
+    python3 scripts/bench.py --pdf --payload heavy --parts 2 --parts 3
+    python3 scripts/bench.py --fields
+
+There is no production data in this repository and there should not be, so the
+payloads are built here: the walk-round photographs every survey has, and a
+number of findings each carrying a photograph of its own. The photographs are
+the size the app sends once it has shrunk them, with some of them tagged as
+taken in portrait so the rotate path is exercised as well.
+
+Each run happens in a fresh Python process. Memory an allocator has already
+been given is rarely handed back, so a second report in the same process looks
+cheaper than it is; a fresh process is the only honest way to see what one
+report costs. Peak memory is sampled from /proc while the report is built and
+given as growth over what the process held before it started.
+
+The point of the numbers is render.yaml. One worker on a 512MB instance was a
+guess made to be safe; this is what says whether two fit.
+
+--save times the last step alone: a finished report saved the way python-docx
+saves it, deflating every part, against app._save_docx, which stores the
+photographs as they are.
+
+--pdf times the conversion alone, needing LibreOffice: the report converted
+whole, against cut into --parts parts converted at once (REPORT_PDF_SPLIT).
+Each way runs once first, untimed, so that LibreOffice's profiles exist and
+its files are in the page cache, as they are on a server that has been up.
+
+--fields times sorting a survey's form into its fields and building the
+template context from them, without photographs, on surveys from a hundred to
+tens of thousands of findings and inventory lines. Per field it should not
+grow with the survey.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+KEY = "bench"
+
+WALK_ROUND = (
+    "vessel", "port_side", "starboard_side", "bow_deck", "main_deck", "salon",
+    "galley", "cabin_01", "cabin_02", "cabin_03", "fwd_head",
+)
+
+SEVERITIES = ("aa", "a", "b", "c", "monitor", "ftr")
+
+# name: (walk-round photographs, findings with a photograph, format)
+PAYLOADS = {
+    "small": (4, 0, "docx"),
+    "typical": (11, 12, "docx"),
+    "heavy": (11, 49, "docx"),
+}
+
+# What the app sends after shrinking, long edge first.
+PHOTO_SIZE = (2016, 1512)
+
+
+def photo(seed, size=PHOTO_SIZE, portrait=False):
+    """A JPEG that compresses about as badly as a real photograph does.
+
+    Flat colour would compress to nothing and make every number here a lie, so
+    this is a gradient under noise with some blocks of colour on top.
+    """
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    width, height = size
+    noise = Image.effect_noise((width, height), 40).convert("RGB")
+    gradient = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    img = Image.blend(gradient, noise, 0.3)
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = rng.randrange(width), rng.randrange(height)
+        colour = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle((x, y, x + width // 6, y + height // 6), fill=colour)
+
+    exif = Image.Exif()
+    if portrait:
+        exif[274] = 6  # Rotated 90 degrees clockwise, the way phones write it.
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=80, exif=exif)
+    return out.getvalue()
+
+
+def build_payload(name, template="survey_template_owner.docx"):
+    """Form fields and files for one made-up survey, as (fields, files)."""
+    walk_round, finding_photos, requested_format = PAYLOADS[name]
+
+    fields = {
+        "template": template,
+        "format": requested_format,
+        "client_name": "Bench Owner",
+        "survey_overview": "A made-up survey for timing the server. " * 20,
+    }
+    files = {}
+
+    for n, base in enumerate(WALK_ROUND[:walk_round]):
+        files[f"{base}_photo"] = (f"{base}.jpg", photo(n, portrait=n % 3 == 0))
+
+    # Findings spread across the severities, the first few lines of each with
+    # a photograph, until the requested number is reached.
+    lines = {sev: [] for sev in SEVERITIES}
+    placed = 0
+    while placed < finding_photos:
+        sev = SEVERITIES[placed % len(SEVERITIES)]
+        lines[sev].append(f"Finding {len(lines[sev]) + 1} noted during the walk.")
+        n = len(lines[sev])
+        files[f"{sev}_finding_{n}_photo"] = (
+            f"{sev}_{n}.jpg", photo(100 + placed, portrait=placed % 4 == 0)
+        )
+        placed += 1
+    for sev in SEVERITIES:
+        lines[sev] += [f"Finding without a photograph {i}." for i in range(3)]
+        fields[f"{sev}_findings"] = "\n".join(lines[sev])
+
+    return fields, files
+
+
+class PeakSampler(threading.Thread):
+    """Reads this process's resident memory every few milliseconds."""
+
+    def __init__(self, rss):
+        super().__init__(daemon=True)
+        self._rss = rss
+        self._done = threading.Event()
+        self.start_bytes = rss() or 0
+        self.peak = self.start_bytes
+
+    def run(self):
+        while not self._done.is_set():
+            self.peak = max(self.peak, self._rss() or 0)
+            time.sleep(0.002)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.peak = max(self.peak, self._rss() or 0)
+        return self.peak - self.start_bytes
+
+
+def child(payload, template):
+    """One report in this process. Prints a JSON line for the parent."""
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    import app as server
+
+    fields, files = build_payload(payload, template)
+    data = dict(fields)
+    for key, (filename, blob) in files.items():
+        data[key] = (io.BytesIO(blob), filename)
+    upload_bytes = sum(len(blob) for _, blob in files.values())
+    estimate = memory_estimate(server, fields, files, template)
+
+    # The multipart body is encoded before the sampler starts: that is the
+    # phone's work, and counting it would charge the server for the upload.
+    from werkzeug.test import EnvironBuilder
+    environ = EnvironBuilder(
+        path="/generate_report",
+        method="POST",
+        data=data,
+        headers={"X-Report-Key": KEY},
+        content_type="multipart/form-data",
+    ).get_environ()
+
+    client = server.app.test_client()
+    sampler = PeakSampler(server._rss_bytes)
+    sampler.start()
+    started = time.perf_counter()
+    response = client.open(environ)
+    elapsed = time.perf_counter() - started
+    grown = sampler.stop()
+
+    print(json.dumps({
+        "status": response.status_code,
+        "seconds": elapsed,
+        "peak_growth": grown,
+        "upload_bytes": upload_bytes,
+        "report_bytes": len(response.data),
+        "photos": len(files),
+        "estimate": estimate,
+    }))
+
+
+def memory_estimate(server, fields, files, template):
+    """What the app estimates this survey will grow a worker by, which the
+    scheduler goes by under REPORT_RENDER_MEMORY_MB."""
+    import survey
+    from werkzeug.datastructures import FileStorage
+
+    uploads = {
+        key: FileStorage(io.BytesIO(blob), filename=filename)
+        for key, (filename, blob) in files.items()
+    }
+    parsed = survey.parse(fields, uploads)
+    found = server._probe_photos(parsed)
+    return server._memory_estimate(parsed, found, server._templates.get(template).names)
+
+
+def save_times(payload, template, repeat):
+    """Seconds and bytes to save one rendered report, both ways."""
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    os.environ.setdefault("REPORT_API_KEY", KEY)
+    import tempfile
+    from docxtpl import DocxTemplate
+    import app as server
+
+    fields, files = build_payload(payload, template)
+    data = dict(fields)
+    for key, (filename, blob) in files.items():
+        data[key] = (io.BytesIO(blob), filename)
+    response = server.app.test_client().post(
+        "/generate_report",
+        data=data,
+        headers={"X-Report-Key": KEY},
+        content_type="multipart/form-data",
+    )
+    rendered = io.BytesIO(response.data)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name, save in (
+            ("python-docx", lambda doc, path: doc.save(path)),
+            ("stored media", server._save_docx),
+        ):
+            times = []
+            for n in range(repeat):
+                rendered.seek(0)
+                doc = DocxTemplate(rendered)
+                path = os.path.join(temp_dir, f"{n}.docx")
+                started = time.perf_counter()
+                save(doc, path)
+                times.append(time.perf_counter() - started)
+            results[name] = (sorted(times)[len(times) // 2], os.path.getsize(path))
+    return results
+
+
+def pdf_times(payload, template, splits, repeat):
+    """Seconds and pages to convert one rendered report, whole and in parts."""
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    os.environ.setdefault("REPORT_API_KEY", KEY)
+    import shutil
+    import tempfile
+    import app as server
+    from pypdf import PdfReader
+
+    if shutil.which("libreoffice") is None:
+        raise SystemExit("--pdf needs libreoffice on the PATH")
+
+    fields, files = build_payload(payload, template)
+    data = dict(fields, format="docx")
+    for key, (filename, blob) in files.items():
+        data[key] = (io.BytesIO(blob), filename)
+    response = server.app.test_client().post(
+        "/generate_report",
+        data=data,
+        headers={"X-Report-Key": KEY},
+        content_type="multipart/form-data",
+    )
+
+    results = {}
+    for split in splits:
+        server.PDF_SPLIT = split
+        times = []
+        for n in range(repeat + 1):
+            with tempfile.TemporaryDirectory() as temp_dir:
+                path = os.path.join(temp_dir, "report.docx")
+                with open(path, "wb") as handle:
+                    handle.write(response.data)
+                started = time.perf_counter()
+                pdf = server._convert(path, time.monotonic() + 170, threading.Event())
+                if n:
+                    times.append(time.perf_counter() - started)
+        pages = len(PdfReader(io.BytesIO(pdf)).pages)
+        results[split] = (sorted(times)[len(times) // 2], pages)
+    return results
+
+
+def text_survey(lines):
+    """Form fields for a survey with `lines` findings and as many inventory
+    lines, each with its date."""
+    fields = {"template": "survey_template_owner.docx", "format": "docx"}
+    for n in range(lines):
+        fields[f"item_{n:05d}"] = f"Inventory line {n}, sound."
+        fields[f"item_{n:05d}_date"] = "05/2026"
+    per_severity = -(-lines // len(SEVERITIES))
+    for sev in SEVERITIES:
+        fields[f"{sev}_findings"] = "\n".join(
+            f"Finding {n} noted during the walk." for n in range(per_severity)
+        )
+    return fields
+
+
+def field_times(template, sizes, repeat):
+    """Microseconds per form field to parse a survey and build its context."""
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    os.environ.setdefault("REPORT_API_KEY", KEY)
+    import app as server
+    import survey
+
+    names = server._templates.get(template).names
+    results = {}
+    for lines in sizes:
+        fields = text_survey(lines)
+        times = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            survey.parse(fields, {}).context(lambda photo, width: None, names)
+            times.append(time.perf_counter() - started)
+        seconds = sorted(times)[len(times) // 2]
+        results[lines] = (len(fields), seconds)
+    return results
+
+
+def run(payload, template, lean):
+    env = dict(os.environ, REPORT_API_KEY=KEY)
+    env["REPORT_LEAN_RENDER"] = "1" if lean else "0"
+    result = subprocess.run(
+        [sys.executable, __file__, "--child", "--payload", payload,
+         "--template", template],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+        raise SystemExit(f"{payload} failed")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def mb(n):
+    return f"{n / (1024 * 1024):6.1f}MB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--payload", choices=sorted(PAYLOADS), action="append")
+    parser.add_argument("--template", default="survey_template_owner.docx")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--save", action="store_true",
+                        help="time only the save, deflated against stored")
+    parser.add_argument("--pdf", action="store_true",
+                        help="time only the PDF conversion, whole against in parts")
+    parser.add_argument("--parts", type=int, action="append",
+                        help="parts to cut the report into for --pdf (default 2)")
+    parser.add_argument("--fields", action="store_true",
+                        help="time only sorting the form and building the context")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    payloads = args.payload or list(PAYLOADS)
+
+    if args.child:
+        child(payloads[0], args.template)
+        return
+
+    if args.pdf:
+        splits = [1] + (args.parts or [2])
+        print(f"{'payload':<9} {'parts':>5} {'seconds':>8} {'pages':>6}")
+        for payload in args.payload or ["heavy"]:
+            results = pdf_times(payload, args.template, splits, args.repeat)
+            for split, (seconds, pages) in results.items():
+                print(f"{payload:<9} {split:>5} {seconds:8.2f} {pages:>6}")
+        return
+
+    if args.fields:
+        print(f"{'findings':>8} {'fields':>7} {'seconds':>8} {'us/field':>9}")
+        sizes = (100, 1000, 10000, 50000)
+        for lines, (count, seconds) in field_times(args.template, sizes, max(args.repeat, 5)).items():
+            print(f"{lines:>8} {count:>7} {seconds:8.4f} {seconds / count * 1e6:9.2f}")
+        return
+
+    if args.save:
+        print(f"{'payload':<9} {'save':<13} {'seconds':>8} {'report':>9}")
+        for payload in payloads:
+            results = save_times(payload, args.template, max(args.repeat, 3))
+            for name, (seconds, size) in results.items():
+                print(f"{payload:<9} {name:<13} {seconds:8.3f} {mb(size)}")
+        return
+
+    print(f"{'payload':<9} {'mode':<8} {'photos':>6} {'upload':>8} "
+          f"{'report':>8} {'seconds':>8} {'peak RSS':>9} {'estimate':>9}")
+    for payload in payloads:
+        for lean in (False, True):
+            results = [run(payload, args.template, lean) for _ in range(args.repeat)]
+            worst = max(results, key=lambda r: r["peak_growth"])
+            seconds = sorted(r["seconds"] for r in results)[len(results) // 2]
+            print(
+                f"{payload:<9} {'lean' if lean else 'default':<8} "
+                f"{worst['photos']:>6} {mb(worst['upload_bytes'])} "
+                f"{mb(worst['report_bytes'])} {seconds:8.2f} "
+                f"{mb(worst['peak_growth'])} {mb(worst['estimate'])}"
+            )
+
+
+if __name__ == "__main__":
+    main()
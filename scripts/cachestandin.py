@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""A stand-in for Redis, for trying the shared cache without one.
+
+    python3 scripts/cachestandin.py 6390
+    REPORT_CACHE_URL=redis://localhost:6390 gunicorn app:app ...
+
+Answers the commands cache.py sends -- GET, SET with EX or PX, AUTH, SELECT --
+and PING, DEL, DBSIZE and FLUSHALL for poking at it by hand with redis-cli. Keys
+live in this process's memory and expire when they should. It is not a Redis:
+one database, no persistence, no maxmemory, and no use to more than one machine.
+
+--password makes AUTH required, to try a URL with one in it. --slow adds a delay
+before every answer, to see what a cache slower than its timeout does.
+"""
+
+import argparse
+import socketserver
+import threading
+import time
+
+_store = {}
+_lock = threading.Lock()
+
+
+def _get(key):
+    with _lock:
+        value, expires = _store.get(key, (None, None))
+        if expires is not None and expires < time.time():
+            del _store[key]
+            return None
+        return value
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        authed = not self.server.password
+        while True:
+            try:
+                args = self._command()
+            except (ConnectionError, ValueError):
+                return
+            if args is None:
+                return
+            if self.server.slow:
+                time.sleep(self.server.slow)
+            name = args[0].upper()
+            if name == b"AUTH":
+                authed = args[-1].decode() == self.server.password
+                self._send(b"+OK\r\n" if authed else b"-WRONGPASS invalid password\r\n")
+            elif not authed:
+                self._send(b"-NOAUTH Authentication required.\r\n")
+            elif name in (b"PING", b"SELECT"):
+                self._send(b"+PONG\r\n" if name == b"PING" else b"+OK\r\n")
+            elif name == b"GET":
+                value = _get(args[1])
+                self._send(b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value))
+            elif name == b"SET":
+                expires = None
+                options = [arg.upper() for arg in args[3::2]]
+                for option, amount in zip(options, args[4::2]):
+                    if option == b"EX":
+                        expires = time.time() + int(amount)
+                    elif option == b"PX":
+                        expires = time.time() + int(amount) / 1000
+                with _lock:
+                    _store[args[1]] = (args[2], expires)
+                self._send(b"+OK\r\n")
+            elif name == b"DEL":
+                with _lock:
+                    gone = sum(_store.pop(key, None) is not None for key in args[1:])
+                self._send(b":%d\r\n" % gone)
+            elif name == b"DBSIZE":
+                self._send(b":%d\r\n" % len(_store))
+            elif name == b"FLUSHALL":
+                with _lock:
+                    _store.clear()
+                self._send(b"+OK\r\n")
+            else:
+                self._send(b"-ERR unknown command '%s'\r\n" % name)
+
+    def _command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # An inline command, as typed into telnet.
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def _send(self, data):
+        self.wfile.write(data)
+
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("port", type=int, nargs="?", default=6379)
+    parser.add_argument("--password")
+    parser.add_argument("--slow", type=float, default=0, help="seconds before every answer")
+    args = parser.parse_args()
+
+    server = Server(("127.0.0.1", args.port), Handler)
+    server.password = args.password
+    server.slow = args.slow
+    print(f"Answering on 127.0.0.1:{args.port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
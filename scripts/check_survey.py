@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Check survey.parse still sorts a form the way reports have always used it.
+
+Run this after changing survey.py.
+
+    python3 scripts/check_survey.py
+
+Why it exists. survey.parse replaced five passes over the form, each with its
+own idea of what a field was, and the first version of it filed a finding's
+base64 photograph as a walk-round one -- prepared for nothing, tiled onto a
+contact sheet captioned "Aa finding 1 photo", and shown in the preview. The
+cases here are the ones the old passes got right on purpose.
+
+Exits 0 when every case holds, 1 when any does not.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from survey import parse  # noqa: E402
+
+
+class Upload:
+    """Stands in for an uploaded file; parse only files it."""
+
+    def __init__(self, filename):
+        self.filename = filename
+
+
+def cases():
+    """(what should hold, whether it does)."""
+    vessel = Upload("vessel.jpg")
+    finding = Upload("aa_1.jpg")
+    survey = parse(
+        {
+            "template": "survey_template_owner.docx",
+            "format": "pdf",
+            "photo_appendix": "1",
+            "hull_date": "04/2026",
+            "hull": "Sound",
+            "keel": "Sound",
+            "keel_date": "05/2026",
+            "survey_date": "2026-05-01",
+            "aa_findings": "Seacock seized\n\n  Hose perished  ",
+            "aa_finding_1_photo_base64": "aGVsbG8=",
+            "vessel_base64": "aGVsbG8=",
+            "galley_base64": "aGVsbG8=",
+            "salon_photo": "ignored",
+            "salon_photo_path": "/etc/passwd",
+            "tender_path": "Davits",
+        },
+        {
+            "vessel_photo": vessel,
+            "aa_finding_1_photo": finding,
+            "notes": Upload("notes.txt"),
+        },
+    )
+    context = survey.context(lambda photo, width: photo.field, names=None)
+
+    yield ("a finding's base64 photograph is not a walk-round photograph",
+           [p.field for p in survey.photos] == ["vessel_photo", "galley_photo"])
+    yield ("an uploaded walk-round photograph wins over its base64",
+           survey.photos[0].file is vessel)
+    yield ("a finding's uploaded photograph is filed with the findings",
+           list(survey.finding_photos) == ["aa_finding_1_photo"])
+    yield ("a finding's photograph is placed beside its line",
+           context["aa_findings_items"][0].photo == "aa_finding_1_photo"
+           and context["aa_findings_items"][1].photo == "")
+    yield ("nothing a template has no name for reaches the context",
+           not any(key.endswith(("_base64", "_photo_photo", "_photo_path")) for key in context)
+           and "salon_photo" not in context and "notes" not in context)
+    yield ("a date sent before its item is the item's date",
+           survey.items["hull"].date == "04/2026" and context["hull_date"] == "04/2026")
+    yield ("a date sent after its item is the item's date",
+           survey.items["keel"].date == "05/2026" and context["keel_date"] == "05/2026")
+    yield ("a date with no item is a field of its own",
+           context["survey_date"] == "2026-05-01" and survey.items["survey_date"].date is None)
+    yield ("options are read, not rendered",
+           survey.options == {"template": "survey_template_owner.docx", "format": "pdf",
+                              "photo_appendix": "1"}
+           and "template" not in context)
+    yield ("a field ending _path that is not a photograph's is text",
+           context["tender_path"] == "Davits")
+    yield ("findings are split into clean lines",
+           context["aa_findings_list"] == ["Seacock seized", "Hose perished"]
+           and context["b_findings_list"] == ["None Observed"])
+    yield ("only the shape the template loops over is made",
+           set(survey.context(lambda photo, width: "", names={"aa_findings_list"}))
+           .isdisjoint({f"{sev}_findings_items" for sev in ("aa", "b")}))
+
+
+def main():
+    failed = 0
+    for what, holds in cases():
+        print(f"  {'ok  ' if holds else 'FAIL'} {what}")
+        failed += not holds
+    if failed:
+        print(f"\n{failed} case{'s' if failed != 1 else ''} failed.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
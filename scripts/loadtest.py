@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+"""Replay the shapes of real report requests against a local server.
+
+bench.py says what one report costs. This says what happens when they overlap:
+where one worker of four threads stops keeping up, and what the app sees when
+it does.
+
+Shapes come from production. Set REPORT_SHAPE_LOG on the server and every
+/generate_report call appends one line to that file saying which template and
+format it asked for, with the other options it sent -- a size budget, the
+photograph appendix -- how long each text field was, and how big each
+photograph was -- never what any of it said or showed. Copy the file down and replay it:
+
+    python3 scripts/loadtest.py replay request_shapes.jsonl \\
+        --rates 0.1,0.25,0.5,1 --duration 60
+
+Without production shapes, make some from bench.py's made-up surveys:
+
+    python3 scripts/loadtest.py synth request_shapes.jsonl --count 40
+
+replay starts gunicorn itself, with --workers and --threads as given (one and
+four unless told otherwise, as render.yaml had it), or aims at --url instead.
+With --front it starts gunicorn behind frontdoor.py, as render.yaml does now.
+Requests arrive at random at each rate in turn, the way phones coming off a
+marina's wifi do, and at the end of each rate it prints:
+
+  - how many reports came back per second
+  - latency at p50, p95 and p99, measured from when the request was due to go,
+    not when a free connection let it go, so a server that falls behind is
+    charged for the wait
+  - how many failed, how many were refused as too large (413), and how many
+    died the way Render shows as a 502 -- dropped connections, timeouts, and
+    502/503/504 answers
+  - how many asked for a PDF and got the DOCX fallback instead
+  - the server's resident memory across the run, workers included
+
+--slow N keeps N more phones uploading throughout, each trickling a survey at
+--slow-kbps kilobytes a second and starting another as soon as one is done --
+the marina with bad wifi. They are not in the table; the table is what
+everyone else gets while they are there. Compare a run with and without
+--front:
+
+    python3 scripts/loadtest.py replay --rates 0.2 --duration 60 --slow 4
+    python3 scripts/loadtest.py replay --rates 0.2 --duration 60 --slow 4 --front
+"""
+
+import argparse
+import base64
+import http.client
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+import bench  # noqa: E402
+
+KEY = "loadtest"
+
+DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+# Photographs the shape log could not measure -- base64 ones -- are made at the
+# size the app sends.
+DEFAULT_PHOTO = bench.PHOTO_SIZE
+
+
+def load_shapes(path):
+    with open(path, encoding="utf-8") as handle:
+        shapes = [json.loads(line) for line in handle if line.strip()]
+    if not shapes:
+        raise SystemExit(f"{path} has no request shapes in it")
+    return shapes
+
+
+def synth(path, count, pdf_share):
+    """Shapes from bench.py's made-up surveys, for when there are no real ones."""
+    rng = random.Random(0)
+    names = list(bench.PAYLOADS)
+    with open(path, "w", encoding="utf-8") as handle:
+        for _ in range(count):
+            fields, files = bench.build_payload(rng.choice(names))
+            shape = {
+                "template": fields.pop("template"),
+                "format": "pdf" if rng.random() < pdf_share else "docx",
+                "text": {key: len(value) for key, value in fields.items()
+                         if key != "format"},
+                "photos": [
+                    {"name": name, "bytes": len(blob),
+                     "width": bench.PHOTO_SIZE[0], "height": bench.PHOTO_SIZE[1]}
+                    for name, (_, blob) in files.items()
+                ],
+            }
+            handle.write(json.dumps(shape) + "\n")
+    print(f"Wrote {count} shapes to {path}")
+
+
+def text_of_length(key, length):
+    """Filler of the right length. Findings keep their line structure, because
+    the server splits them on newlines and the number of lines is the cost."""
+    if key.endswith("_findings"):
+        line = "Finding noted during the walk round."
+        lines = []
+        while sum(len(x) + 1 for x in lines) < length:
+            lines.append(line)
+        return "\n".join(lines)[:length]
+    return "x" * length
+
+
+class Payloads:
+    """Request bodies built from shapes, ahead of time.
+
+    Making a photograph costs the client a tenth of a second. Doing that while
+    the clock runs would measure this script rather than the server, so every
+    body is built before the first request goes.
+    """
+
+    def __init__(self, shapes):
+        self._photos = {}
+        self.bodies = [self._build(shape) for shape in shapes]
+
+    def _photo(self, width, height, seed):
+        size = (width or DEFAULT_PHOTO[0], height or DEFAULT_PHOTO[1])
+        key = (size, seed % 8)
+        if key not in self._photos:
+            self._photos[key] = bench.photo(seed, size=size)
+        return self._photos[key]
+
+    def _build(self, shape):
+        boundary = uuid.uuid4().hex
+        out = io.BytesIO()
+
+        def part(headers, value):
+            out.write(f"--{boundary}\r\n".encode())
+            out.write(headers.encode())
+            out.write(b"\r\n\r\n")
+            out.write(value)
+            out.write(b"\r\n")
+
+        part('Content-Disposition: form-data; name="template"',
+             shape["template"].encode())
+        part('Content-Disposition: form-data; name="format"',
+             shape["format"].encode())
+        for key, value in shape.get("options", {}).items():
+            part(f'Content-Disposition: form-data; name="{key}"', value.encode())
+        for key, length in shape["text"].items():
+            part(f'Content-Disposition: form-data; name="{key}"',
+                 text_of_length(key, length).encode())
+        for n, spec in enumerate(shape["photos"]):
+            blob = self._photo(spec["width"], spec["height"], n)
+            name = spec["name"]
+            if name.endswith("_base64"):
+                part(f'Content-Disposition: form-data; name="{name}"',
+                     base64.b64encode(blob))
+            else:
+                part(
+                    f'Content-Disposition: form-data; name="{name}"; '
+                    f'filename="{name}.jpg"\r\nContent-Type: image/jpeg',
+                    blob,
+                )
+        out.write(f"--{boundary}--\r\n".encode())
+        content_type = f"multipart/form-data; boundary={boundary}"
+        return out.getvalue(), content_type, shape["format"] == "pdf"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workers, threads, timeout, log, front=False):
+    port = free_port()
+    env = dict(os.environ, REPORT_API_KEY=KEY, PORT=str(port))
+    command = [sys.executable, "-m", "gunicorn", "app:app",
+               "--workers", str(workers), "--threads", str(threads),
+               "--timeout", str(timeout)]
+    if front:
+        command = [sys.executable, os.path.join(ROOT, "frontdoor.py")] + command
+    else:
+        command += ["--bind", f"127.0.0.1:{port}"]
+    server = subprocess.Popen(
+        command,
+        cwd=ROOT,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/health")
+            if conn.getresponse().status == 200:
+                return server, url
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise SystemExit("gunicorn did not come up within 30 seconds")
+
+
+def tree_rss(pid):
+    """Resident bytes of a process and its children -- gunicorn's master and
+    every worker it has forked."""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as handle:
+                fields = handle.read().rsplit(")", 1)[1].split()
+            parents[int(entry)] = int(fields[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    family = {pid}
+    grew = True
+    while grew:
+        grew = False
+        for child, parent in parents.items():
+            if parent in family and child not in family:
+                family.add(child)
+                grew = True
+    total = 0
+    for member in family:
+        try:
+            with open(f"/proc/{member}/status") as handle:
+                for line in handle:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, every):
+        super().__init__(daemon=True)
+        self._pid = pid
+        self._every = every
+        self._done = threading.Event()
+        self.samples = []
+
+    def run(self):
+        started = time.monotonic()
+        while not self._done.is_set():
+            self.samples.append((time.monotonic() - started, tree_rss(self._pid)))
+            self._done.wait(self._every)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return self.samples
+
+
+def trickle(body, kbps, stop):
+    """The body, a little at a time, at `kbps` kilobytes a second."""
+    piece = max(1024, int(kbps * 1024 / 10))
+    for at in range(0, len(body), piece):
+        if stop.is_set():
+            raise ConnectionAbortedError("stopped")
+        yield body[at:at + piece]
+        time.sleep(piece / (kbps * 1024))
+
+
+def send(url, body, content_type, timeout, kbps=None, stop=None):
+    """One request. Returns (status or None, mimetype, error). With `kbps`,
+    the body goes at that pace, as from a phone on a weak connection."""
+    parts = urlsplit(url)
+    conn_class = (http.client.HTTPSConnection if parts.scheme == "https"
+                  else http.client.HTTPConnection)
+    conn = conn_class(parts.hostname, parts.port, timeout=timeout)
+    try:
+        conn.request("POST", "/generate_report", body=(
+            body if kbps is None else trickle(body, kbps, stop)
+        ), headers={
+            "Content-Type": content_type,
+            "Content-Length": str(len(body)),
+            "X-Report-Key": os.environ.get("REPORT_API_KEY", KEY),
+        })
+        response = conn.getresponse()
+        response.read()
+        return response.status, response.getheader("Content-Type", ""), None
+    except (OSError, http.client.HTTPException) as e:
+        return None, "", type(e).__name__
+    finally:
+        conn.close()
+
+
+def replay_at(url, payloads, rate, duration, concurrency, timeout, seed):
+    """Poisson arrivals at `rate` per second for `duration` seconds."""
+    rng = random.Random(seed)
+    results = []
+    lock = threading.Lock()
+
+    def one(due, body, content_type, wants_pdf):
+        status, mimetype, error = send(url, body, content_type, timeout)
+        latency = time.monotonic() - due
+        with lock:
+            results.append((latency, status, mimetype, error, wants_pdf))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        started = time.monotonic()
+        due = started
+        while True:
+            due += rng.expovariate(rate)
+            if due - started > duration:
+                break
+            time.sleep(max(0.0, due - time.monotonic()))
+            body, content_type, wants_pdf = rng.choice(payloads.bodies)
+            pool.submit(one, due, body, content_type, wants_pdf)
+    return results
+
+
+class SlowClients:
+    """`count` phones uploading one survey after another at `kbps`, until
+    stopped."""
+
+    def __init__(self, url, payloads, count, kbps, timeout):
+        self._url = url
+        self._payloads = payloads
+        self._kbps = kbps
+        self._timeout = timeout
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.finished = []
+        self._threads = [
+            threading.Thread(target=self._run, args=(n,), daemon=True)
+            for n in range(count)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self, n):
+        rng = random.Random(1000 + n)
+        while not self._stop.is_set():
+            body, content_type, _wants_pdf = rng.choice(self._payloads.bodies)
+            started = time.monotonic()
+            status, _mimetype, _error = send(self._url, body, content_type,
+                                             self._timeout, self._kbps, self._stop)
+            if not self._stop.is_set():
+                with self._lock:
+                    self.finished.append((time.monotonic() - started, status))
+
+    def stop(self):
+        self._stop.set()
+        # One still waiting for its report is left to it.
+        for thread in self._threads:
+            thread.join(timeout=1)
+        with self._lock:
+            return list(self.finished)
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summarise(rate, results, duration):
+    total = len(results)
+    latencies = [r[0] for r in results if r[1] == 200]
+    too_large = sum(1 for r in results if r[1] == 413)
+    # What Render's proxy would have answered 502 for: the worker dropped the
+    # connection or never answered, or it answered with a gateway error itself.
+    gateway = sum(1 for r in results if r[1] is None or r[1] in (502, 503, 504))
+    failed = sum(1 for r in results if r[1] != 200)
+    pdf_asked = [r for r in results if r[4] and r[1] == 200]
+    fallback = sum(1 for r in pdf_asked if r[2].startswith(DOCX))
+
+    def share(n, of):
+        return f"{100 * n / of:5.1f}%" if of else "    -"
+
+    print(
+        f"{rate:6.2f}/s {total:5d} {len(latencies) / duration:6.2f} "
+        f"{percentile(latencies, 50):7.2f} {percentile(latencies, 95):7.2f} "
+        f"{percentile(latencies, 99):7.2f} "
+        f"{share(failed, total)} {share(too_large, total)} "
+        f"{share(gateway, total)} {share(fallback, len(pdf_asked))}",
+        flush=True,
+    )
+
+
+def print_rss(samples):
+    if not samples:
+        return
+    print("\nServer memory over the run:")
+    step = max(1, int(len(samples) / 20))
+    for at, rss in samples[::step]:
+        print(f"  {at:7.1f}s {rss / (1024 * 1024):7.1f}MB")
+    peak = max(rss for _, rss in samples)
+    print(f"  peak     {peak / (1024 * 1024):7.1f}MB")
+
+
+def replay(args):
+    shapes = load_shapes(args.shapes)
+    print(f"Building {len(shapes)} request bodies...", flush=True)
+    payloads = Payloads(shapes)
+
+    server = None
+    log = None
+    url = args.url
+    if not url:
+        log = open(args.server_log, "w")
+        server, url = start_server(args.workers, args.threads, args.timeout, log,
+                                   front=args.front)
+        print(f"gunicorn{' behind frontdoor.py' if args.front else ''} on {url}: "
+              f"{args.workers} worker(s), {args.threads} thread(s)", flush=True)
+
+    sampler = None
+    if server is not None:
+        sampler = RssSampler(server.pid, args.rss_every)
+        sampler.start()
+
+    slow = None
+    if args.slow:
+        slow = SlowClients(url, payloads, args.slow, args.slow_kbps, args.timeout)
+        slow.start()
+        print(f"{args.slow} slow client(s) uploading at {args.slow_kbps:g}kB/s", flush=True)
+
+    try:
+        print(f"\n{'rate':>8} {'sent':>5} {'done/s':>6} {'p50':>7} {'p95':>7} {'p99':>7} "
+              f"{'failed':>6} {'413':>6} {'502':>6} {'pdf->docx':>6}")
+        for n, rate in enumerate(args.rates):
+            results = replay_at(url, payloads, rate, args.duration,
+                                args.concurrency, args.timeout, seed=n)
+            summarise(rate, results, args.duration)
+    finally:
+        if slow is not None:
+            finished = slow.stop()
+            ok = [seconds for seconds, status in finished if status == 200]
+            line = f"\nSlow clients finished {len(finished)} upload(s), {len(ok)} answered 200"
+            if ok:
+                line += f", taking {percentile(ok, 50):.1f}s at p50"
+            print(line, flush=True)
+        if sampler is not None:
+            print_rss(sampler.stop())
+        if server is not None:
+            server.terminate()
+            server.wait()
+            log.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    make = sub.add_parser("synth", help="write made-up shapes")
+    make.add_argument("shapes", nargs="?", default="request_shapes.jsonl")
+    make.add_argument("--count", type=int, default=40)
+    make.add_argument("--pdf-share", type=float, default=0.5,
+                      help="fraction of shapes that ask for a PDF")
+
+    run = sub.add_parser("replay", help="replay shapes against a server")
+    run.add_argument("shapes", nargs="?", default="request_shapes.jsonl")
+    run.add_argument("--url", help="aim here instead of starting gunicorn")
+    run.add_argument("--rates", default="0.1,0.25,0.5,1",
+                     type=lambda v: [float(x) for x in v.split(",")],
+                     help="arrivals per second, one run at each")
+    run.add_argument("--duration", type=float, default=60,
+                     help="seconds of arrivals at each rate")
+    run.add_argument("--concurrency", type=int, default=32,
+                     help="most requests this client has open at once")
+    run.add_argument("--workers", type=int, default=1)
+    run.add_argument("--threads", type=int, default=4)
+    run.add_argument("--timeout", type=int, default=180)
+    run.add_argument("--rss-every", type=float, default=1.0)
+    run.add_argument("--server-log", default=os.devnull)
+    run.add_argument("--front", action="store_true",
+                     help="start gunicorn behind frontdoor.py")
+    run.add_argument("--slow", type=int, default=0,
+                     help="phones uploading slowly throughout")
+    run.add_argument("--slow-kbps", type=float, default=64,
+                     help="how fast each slow phone uploads, in kB/s")
+
+    args = parser.parse_args()
+    if args.command == "synth":
+        synth(args.shapes, args.count, args.pdf_share)
+    else:
+        replay(args)
+
+
+if __name__ == "__main__":
+    main()
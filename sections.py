@@ -0,0 +1,307 @@
+"""Cut a rendered report into parts that convert to PDF separately, and put
+the PDFs back together.
+
+One LibreOffice converting a report with sixty photographs is the slowest thing
+the server does, and it uses one core however many the instance has. The
+report is mostly a run of pages that do not depend on one another -- the cover
+and particulars, the findings, the pages of photographs -- separated by page
+breaks. Cut at those breaks, each part converts on a LibreOffice of its own,
+and the PDFs join into the same pages in the same order.
+
+What this will not cut is a report whose pages know where they are: a PAGE or
+NUMPAGES field in a header or footer, or a table of contents. Each part would
+number from one. None of the templates has them; if one ever does, its reports
+convert in one piece as before.
+
+The parts are balanced by photographs, not pages. A page of text converts in no
+time next to a page carrying three photographs. A run of pages with no break
+between them -- the findings, which flow from one severity into the next --
+stays whole, since cutting it would change where its pages fall; it is often
+the heaviest part, and then it is what the others are balanced against.
+"""
+
+import copy
+import posixpath
+import re
+import shutil
+import zipfile
+
+from docx.oxml import parse_xml
+from docx.oxml.ns import qn
+from lxml import etree
+
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
+
+DOCUMENT = "word/document.xml"
+DOCUMENT_RELS = "word/_rels/document.xml.rels"
+IMAGE_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/image"
+
+# Fields whose value depends on the whole document.
+_WHOLE_DOCUMENT_FIELDS = re.compile(rb"\b(PAGE|NUMPAGES|SECTIONPAGES|TOC|PAGEREF)\b")
+
+_R_ID = re.compile(r'r:(?:embed|id|link)="([^"]+)"')
+
+
+def available():
+    """Whether the PDFs can be put back together here."""
+    return PdfWriter is not None
+
+
+def split_docx(path, parts, name_part):
+    """Cut the DOCX at `path` into at most `parts` DOCX files.
+
+    `name_part(n)` gives the path to write part n to. Returns the paths
+    written, or None when this report is not to be cut -- it has fields that
+    need the whole document, or fewer than two places to cut.
+    """
+    with zipfile.ZipFile(path) as source:
+        for name in source.namelist():
+            if name.startswith("word/") and name.endswith(".xml"):
+                if _has_whole_document_fields(source.read(name)):
+                    return None
+        root = parse_xml(source.read(DOCUMENT))
+        body = root.find(qn("w:body"))
+        children = list(body)
+        sect_pr = None
+        if children and children[-1].tag == qn("w:sectPr"):
+            sect_pr = children.pop()
+            body.remove(sect_pr)
+
+        pages = _pages(children)
+        if len(pages) < 2:
+            return None
+        groups = _balance(pages, parts)
+        if len(groups) < 2:
+            return None
+        groups = _assemble(pages, groups)
+
+        rels = parse_xml(source.read(DOCUMENT_RELS))
+        elsewhere = _targets_outside_document(source)
+
+        written = []
+        for n, group in enumerate(groups):
+            for child in list(body):
+                body.remove(child)
+            for element in group:
+                body.append(element)
+            if sect_pr is not None:
+                last = copy.deepcopy(sect_pr)
+                if n > 0:
+                    # A different first page is the cover's, not every part's.
+                    for title_pg in last.findall(qn("w:titlePg")):
+                        last.remove(title_pg)
+                body.append(last)
+            xml = etree.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True)
+            out = name_part(n)
+            _write_part(source, out, xml, rels, elsewhere)
+            written.append(out)
+    return written
+
+
+def merge_pdfs(paths, out):
+    """Join the PDFs at `paths`, in order, into `out`."""
+    writer = PdfWriter()
+    for path in paths:
+        writer.append(path)
+    with open(out, "wb") as handle:
+        writer.write(handle)
+    writer.close()
+
+
+def _has_whole_document_fields(xml):
+    if b"instrText" not in xml and b"fldSimple" not in xml:
+        return False
+    for instruction in re.findall(rb"<w:instrText[^>]*>([^<]*)<", xml):
+        if _WHOLE_DOCUMENT_FIELDS.search(instruction):
+            return True
+    for instruction in re.findall(rb'w:instr="([^"]*)"', xml):
+        if _WHOLE_DOCUMENT_FIELDS.search(instruction):
+            return True
+    return False
+
+
+def _pages(children):
+    """The body's elements as a list of pages, each (elements, split).
+
+    A page ends at a top-level paragraph with a page break in it, and that
+    paragraph is the last of the page's elements. `split` is the paragraph cut
+    at its break, as (up to the break, after it), for when a part ends on that
+    page: the first half ends the part, and the second -- often nothing but the
+    empty rest of the paragraph, which still takes a line -- starts the next.
+    Otherwise the paragraph stays whole, break and all.
+    """
+    pages = [([], None)]
+    for element in children:
+        if element.tag == qn("w:p"):
+            before = element.find(qn("w:pPr") + "/" + qn("w:pageBreakBefore"))
+            if before is not None and pages[-1][0]:
+                pages.append(([], None))
+            pages[-1][0].append(element)
+            br = _last_page_break(element)
+            if br is not None:
+                pages[-1] = (pages[-1][0], _split_paragraph(element, br))
+                pages.append(([], None))
+            continue
+        pages[-1][0].append(element)
+    if not pages[-1][0]:
+        pages.pop()
+    return pages
+
+
+def _assemble(pages, groups):
+    """The elements of each part, from groups of page numbers."""
+    parts = []
+    for n, group in enumerate(groups):
+        elements = []
+        if n > 0 and pages[group[0] - 1][1] is not None:
+            elements.append(pages[group[0] - 1][1][1])
+        for index in group:
+            elements.extend(pages[index][0])
+        split = pages[group[-1]][1]
+        if n < len(groups) - 1 and split is not None:
+            elements[-1] = split[0]
+        parts.append(elements)
+    return parts
+
+
+def _last_page_break(paragraph):
+    found = None
+    for br in paragraph.iter(qn("w:br")):
+        if br.get(qn("w:type")) != "page":
+            continue
+        # Only breaks in this paragraph's own runs, not in a text box or a
+        # table inside it.
+        parent = br.getparent()
+        while parent is not None and parent.tag != qn("w:p"):
+            parent = parent.getparent()
+        if parent is paragraph:
+            found = br
+    return found
+
+
+def _split_paragraph(paragraph, br):
+    """(the paragraph up to the break, the paragraph after it), break gone."""
+    # The child of the paragraph the break is inside: a run, or a hyperlink
+    # or field wrapped around one.
+    top = br
+    while top.getparent() is not paragraph:
+        top = top.getparent()
+    at = list(paragraph).index(top)
+    path = []
+    node = br
+    while node is not paragraph:
+        parent = node.getparent()
+        path.append(list(parent).index(node))
+        node = parent
+    path.reverse()
+
+    head = copy.deepcopy(paragraph)
+    tail = copy.deepcopy(paragraph)
+    _cut(head, path, keep_before=True)
+    _cut(tail, path, keep_before=False)
+    for child in list(head)[at + 1:]:
+        head.remove(child)
+    for child in list(tail)[:at]:
+        if child.tag != qn("w:pPr"):
+            tail.remove(child)
+    before = tail.find(qn("w:pPr") + "/" + qn("w:pageBreakBefore"))
+    if before is not None:
+        before.getparent().remove(before)
+    return head, tail
+
+
+def _cut(paragraph, path, keep_before):
+    """Remove the break at `path`, and everything after it (or before it) at
+    each level down to it. Properties elements are always kept."""
+    node = paragraph
+    for depth, index in enumerate(path):
+        children = list(node)
+        target = children[index]
+        for i, child in enumerate(children):
+            if child is target or child.tag in (qn("w:pPr"), qn("w:rPr")):
+                continue
+            if depth == 0:
+                # Siblings at the paragraph's own level are trimmed by the
+                # caller.
+                continue
+            if (keep_before and i > index) or (not keep_before and i < index):
+                node.remove(child)
+        node = target
+    node.getparent().remove(node)
+
+
+def _balance(pages, parts):
+    """Contiguous groups of page numbers, at most `parts` of them, with the
+    heaviest group as light as it can be made. A page weighs one, and ten more
+    for each photograph on it."""
+    weights = [
+        1 + 10 * sum(len(element.findall(".//" + qn("w:drawing"))) for element in elements)
+        for elements, _split in pages
+    ]
+
+    def pack(capacity):
+        groups, current, load = [], [], 0
+        for index, weight in enumerate(weights):
+            if current and load + weight > capacity:
+                groups.append(current)
+                current, load = [], 0
+            current.append(index)
+            load += weight
+        groups.append(current)
+        return groups
+
+    # The least capacity that packs into `parts` groups or fewer.
+    low, high = max(weights), sum(weights)
+    while low < high:
+        middle = (low + high) // 2
+        if len(pack(middle)) <= parts:
+            high = middle
+        else:
+            low = middle + 1
+    return pack(low)
+
+
+def _targets_outside_document(source):
+    """Everything some part other than the document body points at."""
+    targets = set()
+    for name in source.namelist():
+        if name.endswith(".rels") and name != DOCUMENT_RELS:
+            base = posixpath.dirname(posixpath.dirname(name))
+            for rel in parse_xml(source.read(name)):
+                if rel.get("TargetMode") != "External":
+                    targets.add(posixpath.normpath(posixpath.join(base, rel.get("Target"))))
+    return targets
+
+
+def _write_part(source, out, xml, rels, elsewhere):
+    """A copy of the package with this part's body, and without the
+    photographs it does not show -- LibreOffice loads every image in the
+    package, used or not."""
+    used = set(_R_ID.findall(xml.decode("utf-8")))
+    kept_rels = copy.deepcopy(rels)
+    dropped = set()
+    for rel in list(kept_rels):
+        if rel.get("Type") == IMAGE_REL and rel.get("Id") not in used:
+            target = posixpath.normpath(posixpath.join("word", rel.get("Target")))
+            if target not in elsewhere:
+                dropped.add(target)
+            kept_rels.remove(rel)
+
+    rels_xml = etree.tostring(kept_rels, xml_declaration=True, encoding="UTF-8", standalone=True)
+    with zipfile.ZipFile(out, "w") as target:
+        for info in source.infolist():
+            if info.filename in dropped:
+                continue
+            # Writing fills in a ZipInfo's sizes, and the source still needs
+            # its own to read the next part from.
+            info = copy.copy(info)
+            if info.filename == DOCUMENT:
+                target.writestr(info, xml)
+            elif info.filename == DOCUMENT_RELS:
+                target.writestr(info, rels_xml)
+            else:
+                with source.open(info) as src, target.open(info, "w") as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
@@ -0,0 +1,231 @@
+"""A survey as the app sends it, sorted once into what each field is.
+
+The form is a few hundred fields: the owner's text for every item the template
+has a row for, most with a `_date` beside it, the findings for each severity as
+one block of lines, and the photographs, as files or base64. What a field was
+used to be decided five times over -- once to pick the text out for the
+context, once for which photographs were walk-round ones, once for which were
+findings', once more to probe them, and once for every line of every severity,
+looking its photograph up -- and the findings were made twice, as strings for
+the professional template and as dicts for the owner template, whichever the
+template used. On a fleet survey with thousands of inventory lines and findings
+that was most of the time before the render.
+
+`parse` looks at each field once and files it: a walk-round photograph, a
+finding's photograph, a severity's findings, one of the options the server
+reads, or an item -- an inventory line or any other text -- with its date.
+`Survey.context` builds what the template is rendered with from that, making
+only the shapes of findings the template has a loop over.
+"""
+
+import re
+
+SEVERITIES = ("aa", "a", "b", "c", "monitor", "ftr")
+
+# A finding's photograph, which the severity loops place beside its text.
+# Named <severity>_finding_<n>_photo.
+FINDING_PHOTO = re.compile(r"^(aa|a|b|c|monitor|ftr)_finding_\d+_photo")
+
+# Read by the server, not shown in the report.
+OPTIONS = ("template", "format", "max_report_bytes", "photo_appendix")
+
+# Inches on the page. A finding's photograph is a detail shot sitting under one
+# line of text, not a plate.
+WALK_ROUND_WIDTH = 4.5
+FINDING_WIDTH = 3.0
+
+
+def split_lines(value):
+    """
+    Split a newline-separated string into a clean list of non-empty lines.
+    Falls back to ['None Observed'] if there are no lines.
+    """
+    text = "" if value is None else str(value)
+    lines = [ln.strip() for ln in text.split('\n') if ln.strip()]
+    return lines if lines else ["None Observed"]
+
+
+class Item:
+    """One line of text on the form, and the date it was last looked at if
+    the form has one for it."""
+
+    __slots__ = ("name", "value", "date")
+
+    def __init__(self, name, value, date=None):
+        self.name = name
+        self.value = value
+        self.date = date
+
+
+class Photo:
+    """A photograph by the name before _photo: an uploaded file, or base64 on
+    the form. A finding's is always a file."""
+
+    __slots__ = ("base", "file", "base64")
+
+    def __init__(self, base, file=None, base64=None):
+        self.base = base
+        self.file = file
+        self.base64 = base64
+
+    @property
+    def field(self):
+        return self.base + "_photo"
+
+
+class Finding:
+    """One line of a severity's findings and the picture placed beside it, or
+    "" for none. The owner template reads `f.text` and `f.photo`."""
+
+    __slots__ = ("text", "photo")
+
+    def __init__(self, text, photo=""):
+        self.text = text
+        self.photo = photo
+
+
+class Survey:
+    """Every field of one survey, by what it is.
+
+    `items` is {name: Item} in the order the form sent them, `photos` the
+    walk-round photographs in the order they were sent -- which is the order
+    they were taken in -- and `finding_photos` {field: Photo}. `findings` is
+    {severity: text} as sent, and `options` the fields in OPTIONS.
+    """
+
+    __slots__ = ("items", "photos", "finding_photos", "findings", "options", "_lines")
+
+    def __init__(self):
+        self.items = {}
+        self.photos = []
+        self.finding_photos = {}
+        self.findings = {}
+        self.options = {}
+        self._lines = {}
+
+    def lines(self, sev):
+        """A severity's findings, a line each."""
+        lines = self._lines.get(sev)
+        if lines is None:
+            lines = self._lines[sev] = split_lines(self.findings.get(sev))
+        return lines
+
+    def photo_fields(self, names=None):
+        """The field of every photograph `context` would place for a template
+        using `names`."""
+        fields = [photo.field for photo in self.photos]
+        if _wants(names, "items"):
+            for sev in SEVERITIES:
+                for n in range(1, len(self.lines(sev)) + 1):
+                    field = f"{sev}_finding_{n}_photo"
+                    if field in self.finding_photos:
+                        fields.append(field)
+        return fields
+
+    def context(self, place, names=None):
+        """The context to render with.
+
+        `place(photo, width)` turns a Photo to be shown `width` inches wide
+        into what goes in the context -- a picture in the document, a
+        thumbnail for a preview -- or None to leave it out.
+        `names` is what the template refers to, if known: findings are made as
+        lines of text for a template that loops over `<sev>_findings_list`, as
+        Findings for one over `<sev>_findings_items`, and both when it is not
+        known.
+        """
+        context = {}
+        for item in self.items.values():
+            context[item.name] = item.value
+            if item.date is not None:
+                context[item.name + "_date"] = item.date
+        for sev, text in self.findings.items():
+            context[f"{sev}_findings"] = text
+
+        for photo in self.photos:
+            placed = place(photo, WALK_ROUND_WIDTH)
+            if placed is not None:
+                context[photo.field] = placed
+
+        # Build arrays for severity loops in the template.
+        #
+        # "monitor" is not a professional survey grade. It means watch this,
+        # which is what an owner writes down most of the time -- 43 of the 56
+        # findings on SV Liquid are monitor. Without it the report omits three
+        # quarters of what a walk turned up. Harmless on the older template,
+        # which has no block to loop over it; the owner template has one.
+        as_lines = _wants(names, "list")
+        as_items = _wants(names, "items")
+        for sev in SEVERITIES:
+            lines = self.lines(sev)
+            if as_lines:
+                context[f"{sev}_findings_list"] = lines
+            if not as_items:
+                continue
+
+            # The same findings, each able to carry a photograph. A finding
+            # without a photograph is an assertion; with one it is evidence.
+            items = []
+            for n, text in enumerate(lines, start=1):
+                photo = self.finding_photos.get(f"{sev}_finding_{n}_photo")
+                items.append(Finding(text, place(photo, FINDING_WIDTH) if photo else ""))
+            context[f"{sev}_findings_items"] = items
+        return context
+
+
+def _wants(names, shape):
+    if names is None:
+        return True
+    return any(f"{sev}_findings_{shape}" in names for sev in SEVERITIES)
+
+
+def parse(form, files):
+    """The Survey in `form` and `files`, looking at each field once.
+
+    A file is a walk-round photograph or a finding's; anything else uploaded
+    is ignored. On the form, `_base64` is a walk-round photograph unless the
+    same one was uploaded as a file or it is named for a finding -- findings'
+    photographs are only ever taken as files, and filed as walk-round ones
+    they would be prepared for nothing and land in the context under a name no
+    template has. `_photo` and `_photo_path` are dropped --
+    the app strips the second and re-sends it as a file -- and a `_date` is
+    its item's date. A `_date` with no item of its own name is an item itself.
+    """
+    survey = Survey()
+    photos = {}
+    for field, file in files.items():
+        if not field.endswith("_photo"):
+            continue
+        if FINDING_PHOTO.match(field):
+            survey.finding_photos[field] = Photo(field[:-len("_photo")], file=file)
+        else:
+            base = field[:-len("_photo")]
+            if base not in photos:
+                photos[base] = Photo(base, file=file)
+                survey.photos.append(photos[base])
+
+    items = survey.items
+    dates = {}
+    for key, value in form.items():
+        # What a field is, is in the word after its last underscore.
+        name, _, kind = key.rpartition("_")
+        if kind == "date":
+            if name in items:
+                items[name].date = value
+            else:
+                dates[name] = value
+        elif kind == "base64":
+            if name not in photos and not FINDING_PHOTO.match(key):
+                photos[name] = Photo(name, base64=value)
+                survey.photos.append(photos[name])
+        elif kind == "photo" or (kind == "path" and name.endswith("_photo")):
+            continue
+        elif kind == "findings" and name in SEVERITIES:
+            survey.findings[name] = value
+        elif key in OPTIONS:
+            survey.options[key] = value
+        else:
+            items[key] = Item(key, value, dates.pop(key, None))
+    # Dates whose item never came: a field in its own right, like survey_date.
+    for name, value in dates.items():
+        items[name + "_date"] = Item(name + "_date", value)
+    return survey